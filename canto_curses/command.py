@@ -418,23 +418,28 @@ class CommandHandler(PluginHandler):
 
         self.meta = False
 
+        # (meta, keycode) -> option name, so that we don't rebuild the same
+        # strings on every keypress.
+
+        self.key_optnames = {}
+
     def translate_key(self, key):
         if key in self.key_translations:
             return self.key_translations[key]
         return key
 
-    def key(self, k):
+    # Translate numeric key into config friendly keyname
 
-        # Translate numeric key into config friendly keyname
+    def key_optname(self, k, meta):
+        try:
+            return self.key_optnames[(meta, k)]
+        except KeyError:
+            pass
 
         optname = self.get_opt_name() + ".key."
 
-        # Add meta prefix.
-        if self.meta:
-            if k >= 64:
-                k -= 64
-                optname += "M-"
-            self.meta = False
+        if meta:
+            optname += "M-"
 
         if k > 255:
             for attr in dir(curses):
@@ -443,21 +448,37 @@ class CommandHandler(PluginHandler):
 
                 if k == getattr(curses, attr):
                     optname += attr[4:].lower()
-
-        # Remember meta for next keypress.
-        elif curses.ascii.ismeta(k):
-            self.meta = True
-            return None
         else:
             keyname = ""
             # Add ctrl prefix.
             if curses.ascii.iscntrl(k):
                 keyname += "C-"
-                k += 96
+                keyname += chr(k + 96)
+            else:
+                keyname += chr(k)
 
-            keyname += chr(k)
             optname += self.translate_key(keyname)
 
+        self.key_optnames[(meta, k)] = optname
+        return optname
+
+    def key(self, k):
+
+        # Add meta prefix.
+        meta = False
+        if self.meta:
+            if k >= 64:
+                k -= 64
+                meta = True
+            self.meta = False
+
+        # Remember meta for next keypress.
+        if k <= 255 and curses.ascii.ismeta(k):
+            self.meta = True
+            return None
+
+        optname = self.key_optname(k, meta)
+
         log.debug("trying key: %s" % optname)
 
         try:
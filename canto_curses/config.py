@@ -19,7 +19,7 @@
 
 from canto_next.hooks import call_hook
 from canto_next.rwlock import RWLock, write_lock, read_lock
-from canto_next.remote import assign_to_dict, access_dict
+from canto_next.remote import assign_to_dict
 
 DEFAULT_FSTRING = "%?{sel}(%{selected}:%{unselected})%?{m}(%{marked}:%{unmarked})%?{rd}(%{read}:%{unread})%{pre}%t%{post}%?{m}(%{marked_end}:%{unmarked_end})%?{rd}(%{read_end}:%{unread_end})%?{sel}(%{selected_end}:%{unselected_end})"
 
@@ -28,7 +28,7 @@ DEFAULT_TAG_FSTRING = "%?{sel}(%{selected}:%{unselected})%?{c}([+]:[-])%{pre} %t
 from .locks import config_lock
 from .subthread import SubThread
 
-from threading import Thread
+from threading import Thread, Lock
 import traceback
 import logging
 import curses   # Colors
@@ -37,6 +37,96 @@ import re
 
 log = logging.getLogger("CONFIG")
 
+# Published configuration is an immutable snapshot. FrozenDict and FrozenList
+# read (and compare) exactly like dicts and lists, but refuse modification, so
+# every reader can share the same snapshot without copying it. Code that wants
+# to change the config gets a mutable copy from copy_conf() / copy_tag_conf(),
+# modifies it, and hands it back to set_conf() / set_tag_conf(), which will
+# publish a new snapshot if anything actually changed.
+
+def _read_only(*args, **kwargs):
+    raise TypeError("Config snapshots are read-only, use copy_conf()")
+
+class FrozenDict(dict):
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    __ior__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+
+class FrozenList(list):
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    __iadd__ = _read_only
+    __imul__ = _read_only
+    append = _read_only
+    extend = _read_only
+    insert = _read_only
+    pop = _read_only
+    remove = _read_only
+    reverse = _read_only
+    sort = _read_only
+    clear = _read_only
+
+def freeze_conf(obj):
+    if isinstance(obj, FrozenDict) or isinstance(obj, FrozenList):
+        return obj
+    if type(obj) == dict:
+        return FrozenDict([ (k, freeze_conf(v)) for (k, v) in obj.items() ])
+    if type(obj) == list:
+        return FrozenList([ freeze_conf(v) for v in obj ])
+    return obj
+
+def thaw_conf(obj):
+    if isinstance(obj, dict):
+        return dict([ (k, thaw_conf(v)) for (k, v) in obj.items() ])
+    if isinstance(obj, list):
+        return [ thaw_conf(v) for v in obj ]
+    return obj
+
+# Option paths (i.e. "story.format_attrs") are split once and kept, they don't
+# depend on the config.
+
+opt_paths = {}
+
+def opt_path(option):
+    try:
+        return opt_paths[option]
+    except KeyError:
+        path = tuple(option.split("."))
+        opt_paths[option] = path
+        return path
+
+def access_path(d, path):
+    for key in path:
+        if not isinstance(d, dict) or key not in d:
+            return (False, None)
+        d = d[key]
+    return (True, d)
+
+# Given an option path, and the changes validate_config() produced with the
+# given validators, decide whether the option's value could have changed.
+# Anything the validators don't know about is assumed changed, because unknown
+# values never show up in changes.
+
+def path_changed(path, changes, validators):
+    for key in path:
+        if type(validators) != dict or key not in validators:
+            return True
+        if key not in changes:
+            return False
+
+        # Basic option, replaced wholesale.
+        if type(validators[key]) != dict:
+            return True
+
+        changes = changes[key]
+        validators = validators[key]
+    return True
+
 # eval settings need to be somehow converted when read from input.
 
 # These are regexes so that window and color types can be handled with easy
@@ -128,7 +218,15 @@ class CantoCursesConfig(SubThread):
                 {
                     "interval" : self.validate_uint,
                     "enabled" : self.validate_bool,
-                }
+                },
+                "lazy" :
+                {
+                    "enabled" : self.validate_bool,
+                    "prefetch" : self.validate_uint,
+                    "trickle" : self.validate_uint,
+                },
+                "attribute_budget" : self.validate_uint,
+                "frame_budget" : self.validate_uint,
             },
 
             "reader" :
@@ -150,6 +248,7 @@ class CantoCursesConfig(SubThread):
                 "search_attributes" : self.validate_string_list,
                 "cursor" : self.validate_taglist_cursor,
                 "border" : self.validate_bool,
+                "story_margin" : self.validate_uint,
             },
 
             "story" :
@@ -229,7 +328,15 @@ class CantoCursesConfig(SubThread):
                 {
                     "interval" : 20,
                     "enabled" : False
-                }
+                },
+                "lazy" :
+                {
+                    "enabled" : False,
+                    "prefetch" : 100,
+                    "trickle" : 50
+                },
+                "attribute_budget" : 64 * 1024 * 1024,
+                "frame_budget" : 500
             },
 
             "reader" :
@@ -282,6 +389,7 @@ class CantoCursesConfig(SubThread):
                 "hide_empty_tags" : True,
                 "border" : False,
                 "search_attributes" : [ "title" ],
+                "story_margin" : 50,
 
                 "key" :
                 {
@@ -440,7 +548,21 @@ class CantoCursesConfig(SubThread):
         for i in range(8, 256):
             self.template_config["color"][str(i)] = i
 
-        self.config = eval(repr(self.template_config))
+        self.config = freeze_conf(eval(repr(self.template_config)))
+
+        # Bumped every time a new config or tag config snapshot is published,
+        # so that anything derived from the config can tell it's stale.
+
+        self.generation = 0
+
+        # Resolved get_opt / get_tag_opt values, by option path. These are
+        # only invalidated when a new snapshot changes them, so most option
+        # reads are a single dict lookup. opt_lock keeps a miss racing a
+        # publish from caching a stale value.
+
+        self.opt_cache = {}
+        self.tag_opt_cache = {}
+        self.opt_lock = Lock()
 
         self.tag_validators = {
             "enumerated" : self.validate_bool,
@@ -458,6 +580,8 @@ class CantoCursesConfig(SubThread):
             "transform" : "None"
         }
 
+        self.tag_template_snapshot = freeze_conf(self.tag_template_config)
+
         self.daemon_defaults = {}
         self.daemon_feedconf = []
 
@@ -466,6 +590,11 @@ class CantoCursesConfig(SubThread):
     def init(self, backend, compatible_version):
         self.vars["location"] = backend.location_args
 
+        # Plugins have been evaluated by now, so pick up any changes they made
+        # to the tag template.
+
+        self.tag_template_snapshot = freeze_conf(self.tag_template_config)
+
         SubThread.init(self, backend)
 
         self.start_pthread()
@@ -692,7 +821,7 @@ class CantoCursesConfig(SubThread):
 
         for key in list(v.keys()):
             if key not in c:
-                c[key] = d[key]
+                c[key] = thaw_conf(d[key])
 
         # Validate existing values.
 
@@ -721,7 +850,7 @@ class CantoCursesConfig(SubThread):
                         dels = {}
                         if type(val) == list:
                             chgs, dels, = self._list_diff(val, d[key])
-                        elif type(val) == dict and type(d[key]) == dict:
+                        elif type(val) == dict and isinstance(d[key], dict):
                             for d_key in d[key].keys():
                                 if d_key not in c[key].keys():
                                     dels[d_key] = "DELETE"
@@ -756,7 +885,10 @@ class CantoCursesConfig(SubThread):
     @write_lock(config_lock)
     def prot_listtags(self, tags):
         self.vars["strtags"] = tags
-        self.config["tagorder"] = tags
+
+        c = self.copy_conf()
+        c["tagorder"] = tags
+        self.publish_conf(c)
 
     def prot_version(self, version):
         self.version = version
@@ -769,13 +901,18 @@ class CantoCursesConfig(SubThread):
     # Note that changes are the only ones propagated through hooks because they
     # are a superset of deletions (i.e. a deletion counts as a change).
 
+    # Changes are written on the bulk lane, the connection that sent
+    # WATCHCONFIGS. The daemon sends CONFIGS to every watcher except the
+    # socket that made the change, so from any other connection our own
+    # changes would come back to us.
+
     @write_lock(config_lock)
     def prot_configs(self, given, write = False):
         log.debug("prot_configs given:\n%s\n" % json.dumps(given, indent=4, sort_keys=True))
 
         if "tags" in given:
             for tag in list(given["tags"].keys()):
-                ntc = given["tags"][tag]
+                ntc = thaw_conf(given["tags"][tag])
 
                 tc = self.get_tag_conf(tag)
 
@@ -783,7 +920,7 @@ class CantoCursesConfig(SubThread):
                         self.validate_config(ntc, tc, self.tag_validators)
 
                 if changes:
-                    self.tag_config[tag] = ntc
+                    self.publish_tag_conf(tag, ntc, changes)
                     call_hook("curses_tag_opt_change", [ { tag : changes } ])
 
                     if write:
@@ -793,14 +930,14 @@ class CantoCursesConfig(SubThread):
                     self.write("DELCONFIGS", { "tags" : { tag : deletions }})
 
         if "CantoCurses" in given:
-            new_config = given["CantoCurses"]
+            new_config = thaw_conf(given["CantoCurses"])
 
             changes, deletions =\
                     self.validate_config(new_config, self.config,\
                     self.validators)
 
             if changes:
-                self.config = new_config
+                self.publish_conf(new_config, changes)
                 call_hook("curses_opt_change", [ changes ])
 
                 if "tags" in changes:
@@ -846,14 +983,16 @@ class CantoCursesConfig(SubThread):
     def prot_newtags(self, tags):
 
         if not self.initd:
+            c = self.copy_conf()
             for tag in tags:
                 if tag not in self.vars["strtags"]:
                     self.vars["strtags"].append(tag)
-                if tag not in self.config["tagorder"]:
-                    self.config["tagorder"].append(tag)
+                if tag not in c["tagorder"]:
+                    c["tagorder"].append(tag)
+            self.publish_conf(c)
             return
 
-        c = self.get_conf()
+        c = self.copy_conf()
 
         # Likely the same as tags
         newtags = []
@@ -869,7 +1008,7 @@ class CantoCursesConfig(SubThread):
 
                 if tag not in self.tag_config:
                     log.debug("Using default tag config for %s" % tag)
-                    self.tag_config[tag] = self.tag_template_config.copy()
+                    self.publish_tag_conf(tag, self.tag_template_snapshot)
 
                 self.vars["strtags"].append(tag)
                 newtags.append(tag)
@@ -890,14 +1029,16 @@ class CantoCursesConfig(SubThread):
     @write_lock(config_lock)
     def prot_deltags(self, tags):
         if not self.initd:
+            c = self.copy_conf()
             for tag in tags:
                 if tag in self.vars["strtags"]:
                     self.vars["strtags"].remove(tag)
-                if tag in self.config["tagorder"]:
-                    self.config["tagorder"].append(tag)
+                if tag in c["tagorder"]:
+                    c["tagorder"].append(tag)
+            self.publish_conf(c)
             return
 
-        c = self.get_conf()
+        c = self.copy_conf()
         changes = False
 
         for tag in tags:
@@ -958,8 +1099,9 @@ class CantoCursesConfig(SubThread):
         raise Exception("Unknown variable: %s" % (tweak,))
 
     # Overall configuration operation functions. The paradigm is that internal
-    # code can "get" the conf, which is a copy of the real conf, modify it,
-    # then "set" the conf which will properly process the changes.
+    # code can "get" the conf, which is the current read-only snapshot, or
+    # "copy" the conf, which is a mutable copy of it, modify it, then "set" the
+    # conf which will properly process the changes.
 
     # prot_configs handles locking
 
@@ -987,15 +1129,60 @@ class CantoCursesConfig(SubThread):
 
         self.prot_configs({ "feeds" : d_f }, True)
 
-    @read_lock(config_lock)
+    # Must be called holding config_lock for writing. Replaces the config
+    # snapshot wholesale, readers holding the old one are unaffected. If
+    # changes is given, only cached options it touches are forgotten.
+
+    def publish_conf(self, conf, changes=None):
+        self.opt_lock.acquire()
+
+        self.config = freeze_conf(conf)
+        self.generation += 1
+
+        if changes == None:
+            self.opt_cache = {}
+        else:
+            for option in list(self.opt_cache.keys()):
+                if path_changed(opt_path(option), changes, self.validators):
+                    del self.opt_cache[option]
+
+        self.opt_lock.release()
+
+    def publish_tag_conf(self, tag, conf, changes=None):
+        self.opt_lock.acquire()
+
+        self.tag_config[tag] = freeze_conf(conf)
+        self.generation += 1
+
+        if tag in self.tag_opt_cache:
+            if changes == None:
+                del self.tag_opt_cache[tag]
+            else:
+                cache = self.tag_opt_cache[tag]
+                for option in list(cache.keys()):
+                    if path_changed(opt_path(option), changes, self.tag_validators):
+                        del cache[option]
+
+        self.opt_lock.release()
+
+    # Snapshots are replaced, never modified, so grabbing a reference doesn't
+    # need config_lock.
+
     def get_conf(self):
-        return eval(repr(self.config), {}, {})
+        return self.config
 
-    @read_lock(config_lock)
     def get_tag_conf(self, tag):
         if tag in self.tag_config:
-            return eval(repr(self.tag_config[tag]), {}, {})
-        return eval(repr(self.tag_template_config), {}, {})
+            return self.tag_config[tag]
+        return self.tag_template_snapshot
+
+    @read_lock(config_lock)
+    def copy_conf(self):
+        return thaw_conf(self.config)
+
+    @read_lock(config_lock)
+    def copy_tag_conf(self, tag):
+        return thaw_conf(self.get_tag_conf(tag))
 
     @read_lock(config_lock)
     def get_def_conf(self):
@@ -1010,35 +1197,54 @@ class CantoCursesConfig(SubThread):
 
     @write_lock(config_lock)
     def set_opt(self, option, value):
-        c = self.get_conf()
+        c = self.copy_conf()
         assign_to_dict(c, option, value)
         self.set_conf(c)
 
-    @read_lock(config_lock)
     def get_opt(self, option):
-        c = self.get_conf()
-        valid, value = access_dict(c, option)
+        try:
+            return self.opt_cache[option]
+        except KeyError:
+            pass
+
+        self.opt_lock.acquire()
+
+        valid, value = access_path(self.config, opt_path(option))
         if not valid:
-            return None
+            value = None
+        self.opt_cache[option] = value
+
+        self.opt_lock.release()
         return value
 
     @write_lock(config_lock)
     def set_tag_opt(self, tag, option, value):
-        tc = self.get_tag_conf(tag)
+        tc = self.copy_tag_conf(tag)
         assign_to_dict(tc, option, value)
         self.set_tag_conf(tag, tc)
 
-    @read_lock(config_lock)
     def get_tag_opt(self, tag, option):
-        tc = self.get_tag_conf(tag)
-        valid, value = access_dict(tc, option)
+        try:
+            return self.tag_opt_cache[tag][option]
+        except KeyError:
+            pass
+
+        self.opt_lock.acquire()
+
+        valid, value = access_path(self.get_tag_conf(tag), opt_path(option))
         if not valid:
-            return None
+            value = None
+
+        if tag not in self.tag_opt_cache:
+            self.tag_opt_cache[tag] = {}
+        self.tag_opt_cache[tag][option] = value
+
+        self.opt_lock.release()
         return value
 
     @write_lock(config_lock)
     def switch_tags(self, tag1, tag2):
-        c = self.get_conf()
+        c = self.copy_conf()
 
         t1_idx = c["tagorder"].index(tag1)
         t2_idx = c["tagorder"].index(tag2)
@@ -78,8 +78,10 @@ class CantoCursesGui(CommandHandler):
             "get_var" : config.get_var,
             "set_conf" : config.set_conf,
             "get_conf" : config.get_conf,
+            "copy_conf" : config.copy_conf,
             "set_tag_conf" : config.set_tag_conf,
             "get_tag_conf" : config.get_tag_conf,
+            "copy_tag_conf" : config.copy_tag_conf,
             "set_defaults" : config.set_def_conf,
             "get_defaults" : config.get_def_conf,
             "set_feed_conf" : config.set_feed_conf,
@@ -112,9 +114,15 @@ class CantoCursesGui(CommandHandler):
         rootlog = logging.getLogger()
         rootlog.addHandler(self.glog_handler)
 
+        # Have attribute updates applied between frames, rather than as fast
+        # as the daemon sends them.
+
+        tag_updater.start_staging(self.release_gui)
+
         register_command(self, "refresh", self.cmd_refresh, [], "Refetch everything from the daemon", "Base")
         register_command(self, "update", self.cmd_update, [], "Sync with daemon", "Base")
         register_command(self, "quit", self.cmd_quit, [], "Quit canto-curses", "Base")
+        register_command(self, "protostats", self.cmd_protostats, [], "Show how long daemon responses take to handle, and attribute store usage", "Base")
 
         self.input_thread = Thread(target = self.run)
         self.input_thread.daemon = True
@@ -156,6 +164,19 @@ class CantoCursesGui(CommandHandler):
     def cmd_quit(self):
         self.alive = False
 
+    def cmd_protostats(self):
+        lines = config.proto_stats_lines("config") +\
+                tag_updater.proto_stats_lines("tagcore")
+        if lines:
+            log.info("\n".join(lines))
+        else:
+            log.info("No daemon responses yet.")
+
+        ats = tag_updater.get_attribute_stats()
+        log.info("attributes: %d entries, %d bytes, %d evicted, %d evictions (%d bytes), %d refetches" %\
+                (ats["entries"], ats["bytes"], ats["evicted"], ats["evictions"],
+                    ats["evicted_bytes"], ats["refetches"]))
+
     def cmdsplit(self, cmd):
         r = escsplit(cmd, " &")
 
@@ -243,6 +264,12 @@ class CantoCursesGui(CommandHandler):
 
             self.glog_handler.flush_deferred_logs()
 
+            # Apply a frame's worth of attribute updates, if there are more,
+            # come back for another frame.
+
+            if tag_updater.apply_staged(self.callbacks["get_opt"]("update.frame_budget")):
+                self.release_gui()
+
             for tag in alltags:
                 if self.sync_requested or (len(tag) == 0 and len(tag.tagcore) != 0):
                     tag.sync()
@@ -227,7 +227,7 @@ class GuiBase(CommandHandler):
     def bind(self, key, cmd, overwrite=False):
         opt = self.get_opt_name()
         key = self.translate_key(key)
-        c = self.callbacks["get_conf"]()
+        c = self.callbacks["copy_conf"]()
         if not cmd:
             if key in c[opt]["key"]:
                 log.info("[%s] %s = %s" % (opt, key, c[opt]["key"][key]))
@@ -306,7 +306,7 @@ class GuiBase(CommandHandler):
         for item in obj.keys():
             stack.append(item)
 
-            if type(obj[item]) == dict:
+            if isinstance(obj[item], dict):
                 r.extend(self._get_current_config_options(obj[item], stack[:]))
             else:
                 r.append(shlex.quote(".".join(stack)))
@@ -378,13 +378,13 @@ class GuiBase(CommandHandler):
             else:
                 tag = sel.parent_tag
 
-            conf = { "tag" : self.callbacks["get_tag_conf"](tag.tag) }
+            conf = { "tag" : self.callbacks["copy_tag_conf"](tag.tag) }
 
             if val != "":
                 assign_to_dict(conf, opt, val)
                 self.callbacks["set_tag_conf"](tag.tag, conf["tag"])
         else:
-            conf = self.callbacks["get_conf"]()
+            conf = self.callbacks["copy_conf"]()
 
             if val != "":
                 assign_to_dict(conf, opt, val)
@@ -16,6 +16,8 @@ from canto_next.hooks import call_hook
 from .config import config, finalize_eval_settings
 from .tagcore import tag_updater, alltagcores
 from .gui import CantoCursesGui
+from .protoloop import protocol_loop
+from .parser import get_parse_stats
 
 from threading import Thread
 from queue import Queue
@@ -60,8 +62,12 @@ class CantoCurses(CantoClient):
         # (debug option)
         self.log_fname_pid = False
 
+        # Whether to multiplex connections on an asyncio loop, instead of
+        # a thread per connection.
+        self.use_asyncio = False
+
         version = "canto-curses " + VERSION + " " + GIT_HASH
-        optl = self.common_args('hl', ["help"], version)
+        optl = self.common_args('hl', ["help", "asyncio"], version)
         if optl == -1:
             sys.exit(-1)
 
@@ -83,10 +89,8 @@ class CantoCurses(CantoClient):
             log.error("Error: %s" % e)
             sys.exit(-1)
 
-        # __init__ above started one connection, start another
-        # for priority stuff.
-
-        self.connect()
+        # The SubThreads (config, tag_updater) open their own bulk and
+        # priority connections.
 
         # Make sure we have permissions on the relevant, non-daemon files in
         # the target directory (None of these will be used until we set_log)
@@ -101,6 +105,10 @@ class CantoCurses(CantoClient):
         self.plugin_errors = try_plugins(self.conf_dir, self.plugin_default, self.disabled_plugins,
                 self.enabled_plugins)
 
+        # Has to be up before config and tag_updater connect.
+        if self.use_asyncio:
+            protocol_loop.start()
+
 
     def print_help(self):
         print("USAGE: canto-curses [options]")
@@ -109,6 +117,7 @@ class CantoCurses(CantoClient):
         print("\t-v/\t\tVerbose logging (for debug)")
         print("\t-D/--dir <dir>\tSet configuration directory.")
         print("\t-l\t\tAppend pid to log file name")
+        print("\t--asyncio\tHandle daemon traffic on an asyncio loop, not threads")
         print("\nPlugin control\n")
         print("\t--noplugins\t\t\t\tDisable plugins")
         print("\t--enableplugins 'plugin1 plugin2...'\tEnable single plugins (overrides --noplugins)")
@@ -125,6 +134,8 @@ class CantoCurses(CantoClient):
                 return 1
             elif opt in ["-l"]:
                 self.log_fname_pid = True
+            elif opt in ["--asyncio"]:
+                self.use_asyncio = True
         return 0
 
     def winch(self, a = None, b = None):
@@ -177,6 +188,26 @@ class CantoCurses(CantoClient):
         log.info("VARS: %s" % config.vars)
         log.info("OPTS: %s" % config.config)
 
+        ps = get_parse_stats()
+        log.info("PARSE CACHE: %d entries, %d hits, %d misses (%.1f%%), %d evictions" %\
+                (ps["size"], ps["hits"], ps["misses"], ps["hit_rate"] * 100, ps["evictions"]))
+
+        ats = tag_updater.get_attribute_stats()
+        log.info("ATTRIBUTES: %d entries, %d bytes, %d evicted, %d evictions (%d bytes), %d refetches" %\
+                (ats["entries"], ats["bytes"], ats["evicted"], ats["evictions"],
+                    ats["evicted_bytes"], ats["refetches"]))
+
+        for tag, latency in tag_updater.get_update_stats():
+            log.info("UPDATE %s: %.3fms" % (tag, latency * 1000))
+
+        for name, sub in [ ("config", config), ("tagcore", tag_updater) ]:
+            for line in sub.proto_stats_lines(name):
+                log.info("PROTO %s" % line)
+            for lane, stats in sorted(sub.get_lane_stats().items()):
+                log.info("LANE %s/%s: %d writes, avg wait %.3fms, max wait %.3fms" %\
+                        (name, lane, stats["writes"], stats["avg_wait"] * 1000,
+                            stats["max_wait"] * 1000))
+
     def child(self, a = None, b = None):
         try:
             while True:
@@ -223,9 +254,19 @@ class CantoCurses(CantoClient):
         if self.plugin_errors:
             log.error("The following error occurred loading plugins:\n\n%s" % self.plugin_errors)
 
-        while self.gui.alive:
-            self.gui.tick()
-            time.sleep(1)
+        if protocol_loop.running:
+            protocol_loop.call_every(1, self.loop_tick)
+            protocol_loop.wait()
+        else:
+            while self.gui.alive:
+                self.gui.tick()
+                time.sleep(1)
+
+    def loop_tick(self):
+        if not self.gui.alive:
+            protocol_loop.stop()
+            return False
+        self.gui.tick()
 
     def ensure_paths(self):
         if os.path.exists(self.conf_dir):
@@ -6,13 +6,17 @@
 #   it under the terms of the GNU General Public License version 2 as 
 #   published by the Free Software Foundation.
 
-# This code provides two top level functions:
+# This code provides three top level functions:
 # parse_conditionals - which will return a list of strings and dicts that are
 #    effectively a parse tree for all of the conditionals in the given format
 #    string
 #
 # eval_theme_string - which will return the final, formatted string given their 
 #    associated values.
+#
+# compile_theme_string - which turns a parse tree into a function that does
+#    the same as eval_theme_string, without re-walking the tree and the
+#    format text every time.
 
 # NOTE: This code guarantees that any given conditional expression or other
 # eval()'d string will be evaluated exactly once. This means that it's
@@ -21,12 +25,25 @@
 
 from .html import html_entity_convert, char_ref_convert
 
+from collections import OrderedDict
+from threading import Lock
 import traceback
 import logging
 import re
 
 log = logging.getLogger("PARSER")
 
+# Parsed format strings are cached, up to PARSE_CACHE_SIZE of them, least
+# recently used first out. The cached trees are shared by everyone parsing the
+# same string, so the sequences in them are tuples, and the dicts must be
+# treated as read-only.
+
+PARSE_CACHE_SIZE = 256
+
+parse_cache = OrderedDict()
+parse_cache_lock = Lock()
+parse_stats = { "hits" : 0, "misses" : 0, "evictions" : 0 }
+
 # Break the first conditional out of a string
 # For example two top level ternaries: 
 #   "Prefix %?{a}(true : false) %?{b}(trueb : falseb)"
@@ -112,18 +129,88 @@ def parse_conditionals(uni):
 
             # For now, toplevel dicts will have only one
             # key, and I can't see a reason to expand it
-            # but let's iterate anyway.
+            # but let's iterate anyway. Build a new dict rather
+            # than replacing values in term.
 
+            parsed_term = {}
             for topkey in term:
+                parsed_term[topkey] = {}
                 for subkey in term[topkey]:
-                    term[topkey][subkey] =\
+                    parsed_term[topkey][subkey] =\
                             parse_conditionals(term[topkey][subkey])
-            ret_strings.append(term)
+            ret_strings.append(parsed_term)
         else:
             ret_strings += parse_conditionals(term)
 
     return ret_strings
 
+# Make a tree from parse_conditionals safe to share.
+
+def _freeze(parsed, top=True):
+    r = []
+    for term in parsed:
+        if type(term) == dict:
+            frozen_term = {}
+            for topkey in term:
+                frozen_term[topkey] = {}
+                for subkey in term[topkey]:
+                    frozen_term[topkey][subkey] = _freeze(term[topkey][subkey], False)
+            r.append(frozen_term)
+        else:
+            r.append(term)
+    if top:
+        return ParsedFormat(r)
+    return tuple(r)
+
+# Cached parse_conditionals. Strings that fail to parse are cached too (as
+# None), so they're only complained about once.
+
+class CachedParseFailure(Exception):
+    pass
+
+def parse_cached(uni):
+    parse_cache_lock.acquire()
+    if uni in parse_cache:
+        parse_cache.move_to_end(uni)
+        parse_stats["hits"] += 1
+        parsed = parse_cache[uni]
+        parse_cache_lock.release()
+
+        if parsed == None:
+            raise CachedParseFailure(uni)
+        return parsed
+
+    parse_stats["misses"] += 1
+    parse_cache_lock.release()
+
+    try:
+        parsed = _freeze(parse_conditionals(uni))
+    except Exception:
+        parsed = None
+        raise
+    finally:
+        parse_cache_lock.acquire()
+        parse_cache[uni] = parsed
+        while len(parse_cache) > PARSE_CACHE_SIZE:
+            parse_cache.popitem(last=False)
+            parse_stats["evictions"] += 1
+        parse_cache_lock.release()
+
+    return parsed
+
+def get_parse_stats():
+    parse_cache_lock.acquire()
+    r = parse_stats.copy()
+    r["size"] = len(parse_cache)
+    parse_cache_lock.release()
+
+    lookups = r["hits"] + r["misses"]
+    if lookups:
+        r["hit_rate"] = r["hits"] / lookups
+    else:
+        r["hit_rate"] = 0.0
+    return r
+
 # This function evaluates a simple string, detecting any
 # python eval sequences.
 
@@ -187,6 +274,148 @@ def eval_theme_string(parsed, values):
             r += _eval_simple(term, values)
     return r
 
+# The compiler. Its output must be exactly what eval_theme_string /
+# _eval_simple would produce for the same values, including which exceptions
+# are raised when, so this is the same state machine as _eval_simple, except
+# that it emits operations instead of output:
+#
+#   ("text", s) - literal text
+#   ("esc", c)  - a single character escape, str(values[c]) if c is in values
+#   ("code", s) - a %{...} expression, str(eval(s))
+#
+# Which of these we end up with never depends on the values.
+
+def _simple_ops(uni):
+    ops = []
+    text = ""
+    escaped = False
+
+    in_code = False
+    long_code = False
+    code = ""
+
+    for c in uni:
+        if escaped:
+            if in_code:
+                code += c
+            else:
+                text += c
+            escaped = False
+        elif c == '\\':
+            escaped = True
+
+        elif c == '}' and in_code and long_code:
+            if text:
+                ops.append(("text", text))
+                text = ""
+            ops.append(("code", code))
+            code = ""
+            in_code = False
+            long_code = False
+        elif c == '{' and in_code and code == "":
+            long_code = True
+        elif in_code:
+            if long_code:
+                code += c
+            else:
+                if text:
+                    ops.append(("text", text))
+                    text = ""
+                ops.append(("esc", c))
+                in_code = False
+        elif c == '%':
+            in_code = True
+        else:
+            text += c
+
+    if text:
+        ops.append(("text", text))
+
+    return ops
+
+class _ThemeCompiler(object):
+    def __init__(self):
+        self.consts = {}
+        self.lines = []
+
+    def const(self, value):
+        name = "_k%d" % len(self.consts)
+        self.consts[name] = value
+        return name
+
+    # Expressions are compiled once. If they don't compile, leave the string
+    # so that eval() fails on it at the same point the interpreter would.
+
+    def code(self, src):
+        try:
+            return self.const(compile(src, "<format>", "eval"))
+        except Exception:
+            return self.const(src)
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def terms(self, parsed, indent):
+        start = len(self.lines)
+
+        for term in parsed:
+            if type(term) == dict:
+                for topkey in term:
+                    branches = term[topkey]
+                    self.emit(indent, "if eval(%s, {}, values):" % self.code(topkey))
+                    self.branch(branches, True, indent + 1)
+                    self.emit(indent, "else:")
+                    self.branch(branches, False, indent + 1)
+            else:
+                for op, arg in _simple_ops(term):
+                    if op == "text":
+                        self.emit(indent, "a(%r)" % (arg,))
+                    elif op == "esc":
+                        self.emit(indent, "if %r in values:" % (arg,))
+                        self.emit(indent + 1, "a(str(values[%r]))" % (arg,))
+                    else:
+                        self.emit(indent, "a(str(eval(%s, {}, values)))" % self.code(arg))
+
+        if len(self.lines) == start:
+            self.emit(indent, "pass")
+
+    # A branch the parser didn't fill in is a KeyError, when it's taken.
+
+    def branch(self, branches, which, indent):
+        if which in branches:
+            self.terms(branches[which], indent)
+        else:
+            self.emit(indent, "raise KeyError(%r)" % (which,))
+
+    def compile(self, parsed):
+        self.emit(0, "def _compiled(values):")
+        self.emit(1, "r = []")
+        self.emit(1, "a = r.append")
+        self.terms(parsed, 1)
+        self.emit(1, "return ''.join(r)")
+
+        namespace = self.consts.copy()
+        exec(compile("\n".join(self.lines), "<compiled format>", "exec"), namespace)
+        return namespace["_compiled"]
+
+def compile_theme_string(parsed):
+    return _ThemeCompiler().compile(parsed)
+
+# A cached parse tree, which compiles itself the first time it's evaluated.
+
+class ParsedFormat(tuple):
+    compiled = None
+
+    def evaluate(self, values):
+        if not self.compiled:
+            self.compiled = compile_theme_string(self)
+        return self.compiled(values)
+
+def evaluate(parsed, values):
+    if type(parsed) == ParsedFormat:
+        return parsed.evaluate(values)
+    return eval_theme_string(parsed, values)
+
 def prep_for_display(s):
     s = s.replace("\\", "\\\\")
     s = s.replace("%", "\\%")
@@ -196,22 +425,24 @@ def prep_for_display(s):
 
 def try_parse(s, default):
     try:
-        parsed = parse_conditionals(s)
+        parsed = parse_cached(s)
+    except CachedParseFailure:
+        parsed = parse_cached(default)
     except Exception as e:
         log.warn("Failed to parse conditionals in fstring: %s" % s)
         log.warn("\n" + "".join(traceback.format_exc()))
         log.warn("Falling back to default.")
-        parsed = parse_conditionals(default)
+        parsed = parse_cached(default)
     return parsed
 
 def try_eval(parsed, values, fallback_parse):
     try:
-        s = eval_theme_string(parsed, values)
+        s = evaluate(parsed, values)
     except Exception as e:
         log.warn("Failed to evaluate fstring: %s with %s" % (parsed, values))
         log.warn("\n" + "".join(traceback.format_exc()))
         log.warn("Falling back to default")
 
-        parsed = parse_conditionals(fallback_parse)
-        s = eval_theme_string(parsed, values)
+        parsed = parse_cached(fallback_parse)
+        s = evaluate(parsed, values)
     return s
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#Canto-curses - ncurses RSS reader
+#   Copyright (C) 2014 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The ProtocolLoop is an optional (--asyncio) asyncio event loop that
+# multiplexes every daemon connection and the timers on a single thread,
+# instead of a blocking read thread per SubThread connection and a
+# threading.Timer per timeout.
+#
+# Responses are still dispatched to the SubThreads' prot_* functions, so
+# nothing that handles them (or plugins that hook them) has to know which is
+# in use. Rendering stays on the GUI thread so a long redraw doesn't hold up
+# traffic, and input stays on its own thread, since commands can block (i.e.
+# the ':' prompt) and write to the daemon.
+
+from threading import Thread, Timer
+import traceback
+import inspect
+import asyncio
+import logging
+
+log = logging.getLogger("PROTOLOOP")
+
+# Find the socket fd behind a backend connection, if the backend exposes it.
+
+def conn_fileno(backend, conn):
+    if hasattr(backend, "fileno"):
+        return backend.fileno(conn)
+
+    # canto_next hands out the sockets themselves.
+
+    if hasattr(conn, "fileno"):
+        return conn.fileno()
+
+    sockets = getattr(backend, "sockets", None)
+    if sockets is None:
+        return None
+
+    try:
+        return sockets[conn].fileno()
+    except Exception:
+        return None
+
+# Whether the backend's do_read takes a timeout, so we can drain anything it
+# has buffered without blocking.
+
+def takes_timeout(backend):
+    try:
+        params = inspect.signature(backend.do_read).parameters.values()
+    except (TypeError, ValueError):
+        return False
+
+    for param in params:
+        if param.kind == param.VAR_POSITIONAL:
+            return True
+    return len(params) >= 2
+
+# A timer that runs on the loop, with the same cancel() as threading.Timer.
+# It can be created and cancelled from any thread.
+
+class LoopTimer(object):
+    def __init__(self, loop, delay, f):
+        self.f = f
+        self.cancelled = False
+        loop.call_soon_threadsafe(loop.call_later, delay, self.fire)
+
+    def fire(self):
+        if not self.cancelled:
+            self.f()
+
+    def cancel(self):
+        self.cancelled = True
+
+class ProtocolLoop(object):
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.run, name="protocol loop")
+        self.thread.daemon = True
+        self.running = True
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.running = False
+            log.info("Protocol loop exiting")
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # Block until the loop is stopped.
+
+    def wait(self):
+        self.thread.join()
+
+    def call_soon(self, f, *args):
+        self.loop.call_soon_threadsafe(f, *args)
+
+    # Call f every interval seconds, until it returns False.
+
+    def call_every(self, interval, f):
+        def wrapper():
+            if f() != False:
+                self.loop.call_later(interval, wrapper)
+        self.loop.call_soon_threadsafe(self.loop.call_later, interval, wrapper)
+
+    def timer(self, delay, f):
+        return LoopTimer(self.loop, delay, f)
+
+    # Call f whenever fd is readable.
+
+    def add_reader(self, fd, f, *args):
+        self.loop.call_soon_threadsafe(self.loop.add_reader, fd, f, *args)
+
+    # Take over reading a SubThread's connections. If the backend doesn't
+    # expose the fds, return False, and the SubThread will use its own
+    # threads.
+
+    def add_subthread(self, sub):
+        lanes = [ (sub.conn, False) ]
+        if sub.pconn != sub.conn:
+            lanes.append((sub.pconn, True))
+
+        fds = []
+        for conn, priority in lanes:
+            fd = conn_fileno(sub.backend, conn)
+            if fd is None:
+                log.debug("No fd for %s, using threads" % sub.__class__.__name__)
+                return False
+            fds.append((fd, priority))
+
+        drain = takes_timeout(sub.backend)
+
+        sub.alive = True
+        for fd, priority in fds:
+            self.add_reader(fd, self.readable, sub, fd, priority, drain)
+        return True
+
+    def readable(self, sub, fd, priority, drain):
+        try:
+            # The backend may have read more than one response off the socket,
+            # those won't make the fd readable again. Never block though, if
+            # only part of a response has arrived it stays buffered until the
+            # rest makes the fd readable.
+
+            if drain:
+                alive = True
+                while alive:
+                    r = sub.read(priority, 0)
+                    if not r:
+                        break
+                    alive = sub.dispatch(r)
+            else:
+                alive = sub.dispatch(sub.read(priority))
+
+        except Exception as e:
+            log.error("Protocol loop exception: %s" % (e,))
+            log.error(''.join(traceback.format_exc()))
+            alive = False
+
+        if not alive:
+            self.loop.remove_reader(fd)
+            log.info("Connection closed - disconnected\nAny further changes will be forgotten!")
+
+protocol_loop = ProtocolLoop()
+
+# Start a timer on the protocol loop if it's running, or as a thread if not.
+# Either way the result can be cancel()ed.
+
+def start_timer(delay, f):
+    if protocol_loop.running:
+        return protocol_loop.timer(delay, f)
+
+    t = Timer(delay, f)
+    t.daemon = True
+    t.start()
+    return t
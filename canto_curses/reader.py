@@ -214,7 +214,7 @@ class Reader(TextBox):
         self._goto(hrefs)
 
     def _toggle_cmd(self, opt):
-        c = self.callbacks["get_conf"]()
+        c = self.callbacks["copy_conf"]()
         c["reader"][opt] = not c["reader"][opt]
         self.callbacks["set_conf"](c)
 
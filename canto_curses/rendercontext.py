@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#Canto-curses - ncurses RSS reader
+#   Copyright (C) 2014 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The RenderContext holds everything Tag and Story rendering needs from the
+# config (resolved story / tagobj / taglist options, parsed formats, passthru
+# escapes and border glyphs). TagList owns one, brings it up to date at the
+# start of every refresh / redraw and hands it down to its Tags, which share it
+# with their Stories, so that rendering N objects doesn't mean N trips through
+# the config.
+
+from .parser import try_parse, get_parse_stats
+from .theme import theme_border
+from .config import config, DEFAULT_FSTRING, DEFAULT_TAG_FSTRING
+
+import logging
+import time
+
+log = logging.getLogger("RENDER")
+
+# These are escapes that are handled in theme_print and should remain present
+# after evaluation.
+
+PASSTHRU_ESCAPES = "RrDdUuBbSs012345678["
+
+# Attributes Story.lines() uses directly, on top of story.format_attrs.
+
+STORY_ATTRS = [ "title", "link", "canto-state", "canto-tags" ]
+
+class RenderContext(object):
+    def __init__(self):
+        self.generation = None
+
+        # Setup cost statistics.
+        self.builds = 0
+        self.build_time = 0.0
+        self.total_build_time = 0.0
+
+    # Return self, rebuilt if the config has changed since the last build.
+    # This is just an integer compare when nothing has changed, so it's safe
+    # to call for every object rendered.
+
+    def current(self):
+        if self.generation != config.generation:
+            self.build()
+        return self
+
+    def build(self):
+        start = time.time()
+
+        self.generation = config.generation
+
+        self.story_conf = config.get_opt("story")
+        self.tagobj_conf = config.get_opt("tagobj")
+        self.taglist_conf = config.get_opt("taglist")
+
+        # Attributes a story needs before it can be rendered.
+        self.story_attrs = STORY_ATTRS[:]
+        for attr in self.story_conf["format_attrs"]:
+            if attr not in self.story_attrs:
+                self.story_attrs.append(attr)
+
+        # Parsed formats, the main formats are pre-parsed, pre_format /
+        # post_format strings set by plugins are parsed on demand.
+
+        self.parsed = {}
+        self.story_parsed = self.parse(self.story_conf["format"], DEFAULT_FSTRING)
+        self.tag_parsed = self.parse(self.tagobj_conf["format"], DEFAULT_TAG_FSTRING)
+
+        escapes = {}
+        for c in PASSTHRU_ESCAPES:
+            escapes[c] = "%" + c
+
+        # Add refactored themability variables:
+
+        self.story_passthru = escapes.copy()
+        for attr in [ "selected", "read", "marked" ]:
+            for var in [ attr, "un" + attr, attr + "_end", "un" + attr + "_end" ]:
+                self.story_passthru[var] = self.story_conf[var]
+
+        self.tag_passthru = escapes.copy()
+        for attr in [ "selected", "unselected", "selected_end", "unselected_end" ]:
+            self.tag_passthru[attr] = self.tagobj_conf[attr]
+
+        self.border = {}
+        for code in [ "ls", "rs", "ts", "bs", "tl", "tr", "bl", "br" ]:
+            self.border[code] = theme_border(code)
+
+        if self.taglist_conf["border"]:
+            self.story_left = "%C%B" + self.border["ls"] + "%b %c"
+            self.story_left_more = "%C%B" + self.border["ls"] + "%b     %c"
+            self.story_right = "%C %B" + self.border["rs"] + "%b%c"
+        else:
+            self.story_left = "%C %c"
+            self.story_left_more = "%C     %c"
+            self.story_right = "%C %c"
+
+        # Per-tag config snapshots, filled as tags ask for them.
+        self.tag_confs = {}
+
+        self.build_time = time.time() - start
+        self.total_build_time += self.build_time
+        self.builds += 1
+
+        log.debug("Render context %d built in %.3fms (parse cache hit rate %.1f%%)" %\
+                (self.builds, self.build_time * 1000,
+                    get_parse_stats()["hit_rate"] * 100))
+
+    def parse(self, fmt, default):
+        key = (fmt, default)
+        if key not in self.parsed:
+            self.parsed[key] = try_parse(fmt, default)
+        return self.parsed[key]
+
+    def tag_conf(self, tag):
+        if tag not in self.tag_confs:
+            self.tag_confs[tag] = config.get_tag_conf(tag)
+        return self.tag_confs[tag]
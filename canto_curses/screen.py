@@ -162,7 +162,7 @@ class Screen(CommandHandler):
             self.callbacks["set_var"]("needs_resize", True)
 
         for key in list(conf.keys()):
-            if type(conf[key]) == dict and "window" in conf[key]:
+            if isinstance(conf[key], dict) and "window" in conf[key]:
                 self.callbacks["set_var"]("needs_resize", True)
                 break
 
@@ -175,20 +175,22 @@ class Screen(CommandHandler):
     def _subw_size_height(self, ci, height):
         window_conf = self.callbacks["get_opt"](ci.get_opt_name() + ".window")
 
-        if not window_conf["maxheight"]:
-            window_conf["maxheight"] = height
+        maxheight = window_conf["maxheight"]
+        if not maxheight:
+            maxheight = height
         req_height = ci.get_height(height)
 
-        return min(height, window_conf["maxheight"], req_height)
+        return min(height, maxheight, req_height)
 
     def _subw_size_width(self, ci, width):
         window_conf = self.callbacks["get_opt"](ci.get_opt_name() + ".window")
 
-        if not window_conf["maxwidth"]:
-            window_conf["maxwidth"] = width
+        maxwidth = window_conf["maxwidth"]
+        if not maxwidth:
+            maxwidth = width
         req_width = ci.get_width(width)
 
-        return min(width, window_conf["maxwidth"], req_width)
+        return min(width, maxwidth, req_width)
 
     # _subw_layout_size will return the total size of layout
     # in either height or width where layout is a list of curses
@@ -710,7 +712,7 @@ class Screen(CommandHandler):
         return (list(colors.keys()), c)
 
     def cmd_color(self, idx, fg, bg):
-        conf = self.callbacks["get_conf"]()
+        conf = self.callbacks["copy_conf"]()
 
         log.debug(":COLOR IDX: %s" % idx)
         if idx in ['deffg', 'defbg']:
@@ -9,8 +9,8 @@
 from canto_next.plugins import Plugin, PluginHandler
 from canto_next.hooks import on_hook, unhook_all
 
-from .theme import FakePad, WrapPad, theme_print, theme_len, theme_reset, theme_border
-from .parser import try_parse, try_eval, prep_for_display
+from .theme import DisplayList, theme_print, theme_len, theme_reset
+from .parser import try_eval, prep_for_display
 from .config import DEFAULT_FSTRING
 from .tagcore import tag_updater
 
@@ -23,20 +23,67 @@ log = logging.getLogger("STORY")
 class StoryPlugin(Plugin):
     pass
 
+# Stories that are currently materialized (see below).
+
+livestories = []
+
+NO_PLUGIN_ATTRS = {}
+
 # The Story class is the basic wrapper for an item to be displayed. It manages
 # its own state only because it affects its representation, it's up to a higher
 # class to actually communicate state changes to the backend.
 
+# Every item in a Tag has a Story, but most of them are never on screen, so a
+# Story starts out cold: just its id, state and content. Everything needed to
+# display it (hooks, plugin lookups, pads) is only set up by materialize(),
+# which happens the first time it's rendered, and is dropped again by
+# recycle() once TagList decides it's scrolled far enough away.
+
+# Stories don't hook curses_attributes, their Tag subscribes to their ids and
+# passes on their updates.
+
+# There can be a lot of Stories, so they're slotted. Anything not listed here
+# (i.e. set by plugins) still works, it just ends up in a per-instance dict.
+
 class Story(PluginHandler):
+    __slots__ = [ "plugin_attrs", "callbacks", "parent_tag", "id", "pad", "display",
+            "selected", "marked", "changed", "fresh_state", "fresh_tags",
+            "width", "extra_lines", "pre_format", "post_format", "offset",
+            "rel_offset", "sel_offset", "enumerated", "rel_enumerated",
+            "content", "new_content", "plugins_loaded", "live", "live_frame",
+            "lns", "evald_string", "left", "left_more", "right",
+
+            # Set by TagList
+            "curpos", "prev_obj", "next_obj", "prev_story", "next_story",
+            "prev_sel", "next_sel" ]
+
+    is_tag = False
+
+    # Which plugins apply, and the lookup table they produce, is the same for
+    # every Story, so it's worked out once, by the first Story materialized
+    # (see load_plugins()). Every Story still gets its own plugin instances,
+    # they may set it up (i.e. favorites adds to pre_format), but they share
+    # the table. If an override is bound to a plugin instance, it belongs to
+    # that Story, so then each Story does its own lookups after all.
+
+    plugin_class = StoryPlugin
+    plugins = None
+    plugin_table = None
+    plugin_table_shared = False
+
     def __init__(self, tag, id, callbacks):
-        PluginHandler.__init__(self)
+
+        # PluginHandler is only properly set up if we end up doing plugin
+        # lookups, until then all Stories share an empty plugin_attrs.
+
+        self.plugin_attrs = NO_PLUGIN_ATTRS
 
         self.callbacks = callbacks
 
         self.parent_tag = tag
-        self.is_tag = False
         self.id = id
         self.pad = None
+        self.display = None
 
         self.selected = False
         self.marked = False
@@ -62,26 +109,100 @@ class Story(PluginHandler):
         self.enumerated = False
         self.rel_enumerated = False
 
-        # This should exist before the hook is setup, or the hook will fail.
-        self.content = {}
-
-        on_hook("curses_opt_change", self.on_opt_change, self)
-        on_hook("curses_tag_opt_change", self.on_tag_opt_change, self)
-        on_hook("curses_attributes", self.on_attributes, self)
-
         # Grab initial content, if any, the rest will be handled by the
         # attributes hook
 
         self.content = tag_updater.get_attributes(self.id)
         self.new_content = None
 
-        self.plugin_class = StoryPlugin
-        self.update_plugin_lookups()
+        self.plugins_loaded = False
+
+        # Materialization state, live_frame is the last TagList frame that
+        # wanted us live.
+        self.live = False
+        self.live_frame = 0
 
     def die(self):
         self.parent_tag = None
+        if self.live:
+            self.live = False
+            unhook_all(self)
+
+    def materialize(self):
+        if self.live:
+            return
+
+        self.live = True
+        livestories.append(self)
+
+        on_hook("curses_opt_change", self.on_opt_change, self)
+        on_hook("curses_tag_opt_change", self.on_tag_opt_change, self)
+
+        if not self.plugins_loaded:
+            self.load_plugins()
+            self.plugins_loaded = True
+
+        # We haven't been listening to option changes, so make sure we have
+        # what the current format needs.
+
+        needed_attrs = []
+        for attr in self.parent_tag.get_render_context().story_attrs:
+            if attr not in self.content:
+                needed_attrs.append(attr)
+        if needed_attrs:
+            tag_updater.need_attributes(self.id, needed_attrs)
+
+        self.changed = True
+
+    def load_plugins(self):
+        if Story.plugins == None:
+            Story.plugins = StoryPlugin.__subclasses__()
+        if not Story.plugins:
+            return
+
+        if Story.plugin_table_shared:
+            self.plugin_class_instances = [ c(self) for c in Story.plugins ]
+            self.plugin_attrs = Story.plugin_table
+            return
+
+        PluginHandler.__init__(self)
+        self.update_plugin_lookups()
+
+        if Story.plugin_table != None:
+            return
+
+        # First Story, resolve for everyone. Plugins that failed to initialize
+        # have been dropped from our instances, so they're dropped for good.
+
+        Story.plugins = [ i.__class__ for i in self.plugin_class_instances ]
+
+        if self.plugin_attrs:
+            Story.plugin_table = self.plugin_attrs
+        else:
+            Story.plugin_table = NO_PLUGIN_ATTRS
+            self.plugin_attrs = NO_PLUGIN_ATTRS
+
+        Story.plugin_table_shared = True
+        for value in self.plugin_attrs.values():
+            if isinstance(getattr(value, "__self__", None), StoryPlugin):
+                Story.plugin_table_shared = False
+                break
+
+    # Drop everything materialize() and rendering set up. Our entry in
+    # livestories is cleaned up by TagList.
+
+    def recycle(self):
+        if not self.live:
+            return
+
+        self.live = False
         unhook_all(self)
 
+        self.pad = None
+        self.display = None
+        self.width = 0
+        self.changed = True
+
     def __eq__(self, other):
         if not other:
             return False
@@ -253,18 +374,22 @@ class Story(PluginHandler):
         self.callbacks["set_var"]("needs_refresh", True)
 
     def lines(self, width):
+        if not self.live:
+            self.materialize()
+
         if width == self.width and not self.changed:
             return self.lns + self.extra_lines
 
-        # Make sure we actually have all of the attributes needed
-        # to complete the render.
-
-        story_conf = self.callbacks["get_opt"]("story")
+        ctx = self.parent_tag.get_render_context()
+        story_conf = ctx.story_conf
 
         self.enumerated = story_conf["enumerated"]
-        self.rel_enumerated = self.callbacks["get_tag_opt"]("enumerated")
+        self.rel_enumerated = ctx.tag_conf(self.parent_tag.tag)["enumerated"]
 
-        for attr in story_conf["format_attrs"]:
+        # Make sure we actually have all of the attributes needed
+        # to complete the render.
+
+        for attr in ctx.story_attrs:
             if attr not in self.content:
 
                 # Not having needed info is a good reason to
@@ -282,28 +407,13 @@ class Story(PluginHandler):
 
                 self.evald_string = "Waiting on content..."
 
+                self.display = None
                 self.lns = 1
                 return self.lns
 
-        parsed = try_parse(story_conf["format"], DEFAULT_FSTRING)
-        parsed_pre = try_parse(self.pre_format, "")
-        parsed_post = try_parse(self.post_format, "")
-
-        # These are escapes that are handled in the theme_print
-        # lower in the function and should remain present after
-        # evaluation.
-
-        passthru = {}
-        for c in "RrDdUuBbSs012345678[":
-            passthru[c] = "%" + c
-
-        # Add refactored themability variables:
-
-        for attr in [ "selected", "read", "marked" ]:
-            passthru[attr] = story_conf[attr]
-            passthru["un" + attr] = story_conf["un" + attr]
-            passthru[attr + "_end"] = story_conf[attr + "_end"]
-            passthru["un" + attr + "_end"] = story_conf["un" + attr + "_end"]
+        parsed = ctx.story_parsed
+        parsed_pre = ctx.parse(self.pre_format, "")
+        parsed_post = ctx.parse(self.post_format, "")
 
         values = { 'sel' : self.selected,
                     'm' : self.marked,
@@ -320,28 +430,24 @@ class Story(PluginHandler):
             if type(values[value]) == str:
                 values[value] = prep_for_display(values[value])
 
-        values.update(passthru)
+        # Escapes handled by theme_print, and themability variables.
+
+        values.update(ctx.story_passthru)
 
         values["pre"] = try_eval(parsed_pre, values, "")
         values["post"] = try_eval(parsed_post, values, "")
         self.evald_string = try_eval(parsed, values, DEFAULT_FSTRING)
 
-        taglist_conf = self.callbacks["get_opt"]("taglist")
-
-        if taglist_conf["border"]:
-            self.left = "%C%B" + theme_border("ls") + "%b %c"
-            self.left_more = "%C%B" + theme_border("ls") + "%b     %c"
-            self.right = "%C %B" + theme_border("rs") + "%b%c"
-        else:
-            self.left = "%C %c"
-            self.left_more = "%C     %c"
-            self.right = "%C %c"
+        self.left = ctx.story_left
+        self.left_more = ctx.story_left_more
+        self.right = ctx.story_right
 
         self.pad = None
         self.width = width
         self.changed = False
 
-        self.lns = self.render(FakePad(width), width)
+        self.display = DisplayList(width)
+        self.lns = self.render(self.display, width)
         return self.lns
 
     def pads(self, width):
@@ -349,7 +455,13 @@ class Story(PluginHandler):
             return self.lns
 
         self.pad = curses.newpad(self.lines(width), width)
-        self.render(WrapPad(self.pad), width)
+
+        # Still waiting on content, lines() didn't render anything.
+        if not self.display:
+            self.display = DisplayList(width)
+            self.render(self.display, width)
+
+        self.display.blit(self.pad)
         return self.lns
 
     def render(self, pad, width):
@@ -9,12 +9,43 @@
 # SubThread is just a basic wrapper for a sub connection from the backend that
 # dispatches to sub functions based on socket traffic
 
+# Each SubThread actually has two connections, or lanes. Bulk traffic (ITEMS,
+# automatic ATTRIBUTES etc.) goes over the first, and writes made with
+# priority=True go over the second, so that something the user is waiting on
+# doesn't queue up behind megabytes of updates. Both are dispatched to the same
+# prot_* functions, each from its own thread, or from the protocol loop if
+# it's running (see protoloop.py).
+
+from .protoloop import protocol_loop
+
 from threading import Thread, Lock
+from collections import deque
 import traceback
 import logging
+import time
 
 log = logging.getLogger("SUBTHREAD")
 
+# How many recent handler timings are kept per command for percentiles.
+
+PROTO_SAMPLES = 256
+
+# Rough size of a response, in entries rather than bytes, so it's cheap. An
+# ITEMS response counts its ids, an ATTRIBUTES response its attributes.
+
+def payload_entries(args):
+    if type(args) == dict:
+        n = 0
+        for v in args.values():
+            if type(v) in [ list, dict ]:
+                n += len(v)
+            else:
+                n += 1
+        return n
+    if type(args) == list:
+        return len(args)
+    return 1
+
 class SubThread(object):
     def init(self, backend):
         self.backend = backend
@@ -22,9 +53,38 @@ class SubThread(object):
         self.wlock = Lock()
         self.rlock = Lock()
 
-        # Start up our own connection
+        # Start up our own connections
         self.conn = backend.connect()
+        self.pconn = backend.connect()
+
+        # If the backend only gives us one connection, the priority lane has
+        # to share it.
+
+        if self.pconn == self.conn:
+            self.pwlock = self.wlock
+            self.prlock = self.rlock
+        else:
+            self.pwlock = Lock()
+            self.prlock = Lock()
+
+        # Per lane write stats, time spent waiting for the lane and writing.
+        self.lane_stats = {}
+        for lane in [ "bulk", "priority" ]:
+            self.lane_stats[lane] = { "writes" : 0, "wait" : 0.0,
+                    "max_wait" : 0.0, "write" : 0.0 }
+
+        # Dispatch table, response -> prot_* handler, and handler stats.
+
+        self.handlers = {}
+        for attr in dir(self):
+            if attr.startswith("prot_"):
+                self.handlers[attr[5:].upper()] = getattr(self, attr)
+
+        self.proto_stats = {}
+        self.stats_lock = Lock()
+
         self.prot_thread = None
+        self.pprot_thread = None
         self.alive = False
 
     def prot_except(self, exception):
@@ -38,44 +98,137 @@ class SubThread(object):
     def prot_info(self, info):
         log.info("%s" % info)
 
-    def write(self, cmd, args):
-        self.wlock.acquire()
-        r = self.backend.do_write(self.conn, cmd, args)
-        self.wlock.release()
+    def write(self, cmd, args, priority=False):
+        if priority:
+            lane, lock, conn = "priority", self.pwlock, self.pconn
+        else:
+            lane, lock, conn = "bulk", self.wlock, self.conn
+
+        start = time.time()
+        lock.acquire()
+        acquired = time.time()
+        r = self.backend.do_write(conn, cmd, args)
+        done = time.time()
+
+        stats = self.lane_stats[lane]
+        stats["writes"] += 1
+        stats["wait"] += acquired - start
+        stats["max_wait"] = max(stats["max_wait"], acquired - start)
+        stats["write"] += done - acquired
+
+        lock.release()
+
+    def read(self, priority=False, timeout=None):
+        if priority:
+            lock, conn = self.prlock, self.pconn
+        else:
+            lock, conn = self.rlock, self.conn
+
+        lock.acquire()
+        try:
+            if timeout == None:
+                r = self.backend.do_read(conn)
+            else:
+                r = self.backend.do_read(conn, timeout)
+        finally:
+            lock.release()
+        return r
 
-    def read(self):
-        self.rlock.acquire()
-        r = self.backend.do_read(self.conn)
-        self.rlock.release()
+    def get_lane_stats(self):
+        r = {}
+        for lane, stats in self.lane_stats.items():
+            r[lane] = stats.copy()
+            if stats["writes"]:
+                r[lane]["avg_wait"] = stats["wait"] / stats["writes"]
+            else:
+                r[lane]["avg_wait"] = 0.0
         return r
 
-    def pthread(self):
-        self.alive = True
+    # Handle a single read result, returning False if the connection is gone.
 
-        try:
-            while self.alive:
-                r = self.read()
+    def dispatch(self, r):
+        if not r:
+            return True
 
-                if not r:
-                    continue
+        # HUP
+        if r == 16:
+            self.alive = False
+            return False
 
-                # HUP
-                if r == 16:
-                    self.alive = False
-                    break
+        cmd, args = r
+
+        handler = self.handlers.get(cmd)
+        if not handler:
+            handler = getattr(self, "prot_" + cmd.lower(), None)
+            if not handler:
+                log.error("Unknown response?")
+                log.error("%s - %s" % (cmd, args))
+                return True
+            self.handlers[cmd] = handler
 
-                cmd, args = r
-                protfunc = "prot_" + cmd.lower()
-                if hasattr(self, protfunc):
-                    getattr(self, protfunc)(args)
+        start = time.time()
+        handler(args)
+        self.record_response(cmd, args, time.time() - start)
 
-                    # For test-suite
-                    if hasattr(self.backend, "processed"):
-                        self.backend.processed(cmd, args)
+        # For test-suite
+        if hasattr(self.backend, "processed"):
+            self.backend.processed(cmd, args)
 
-                else:
-                    log.error("Unknown response?")
-                    log.error("%s - %s" % (cmd, args))
+        return True
+
+    def record_response(self, cmd, args, elapsed):
+        self.stats_lock.acquire()
+
+        if cmd not in self.proto_stats:
+            self.proto_stats[cmd] = { "count" : 0, "entries" : 0, "time" : 0.0,
+                    "max" : 0.0, "samples" : deque(maxlen=PROTO_SAMPLES) }
+
+        stats = self.proto_stats[cmd]
+        stats["count"] += 1
+        stats["entries"] += payload_entries(args)
+        stats["time"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+        stats["samples"].append(elapsed)
+
+        self.stats_lock.release()
+
+    # Handler stats per response, with p50 / p99 over the recent samples.
+
+    def get_proto_stats(self):
+        r = {}
+
+        self.stats_lock.acquire()
+        for cmd, stats in self.proto_stats.items():
+            samples = sorted(stats["samples"])
+            r[cmd] = { "count" : stats["count"], "entries" : stats["entries"],
+                    "time" : stats["time"], "max" : stats["max"],
+                    "p50" : samples[int(0.50 * (len(samples) - 1))],
+                    "p99" : samples[int(0.99 * (len(samples) - 1))] }
+        self.stats_lock.release()
+
+        return r
+
+    # Stats as log lines, most total time first.
+
+    def proto_stats_lines(self, name):
+        stats = self.get_proto_stats()
+        cmds = sorted(stats.keys(), key=lambda x : stats[x]["time"], reverse=True)
+
+        lines = []
+        for cmd in cmds:
+            s = stats[cmd]
+            lines.append("%s %s: %d msgs, %d entries, p50 %.2fms, p99 %.2fms, max %.2fms, total %.2fms" %\
+                    (name, cmd, s["count"], s["entries"], s["p50"] * 1000,
+                        s["p99"] * 1000, s["max"] * 1000, s["time"] * 1000))
+        return lines
+
+    def pthread(self, priority=False):
+        self.alive = True
+
+        try:
+            while self.alive:
+                if not self.dispatch(self.read(priority)):
+                    break
         except Exception as e:
             log.error("Thread exception: %s" % (e,))
             log.error(''.join(traceback.format_exc()))
@@ -83,7 +236,15 @@ class SubThread(object):
         log.info("Thread exiting - disconnected\nAny further changes will be forgotten!")
 
     def start_pthread(self):
+        if protocol_loop.running and protocol_loop.add_subthread(self):
+            return
+
         self.prot_thread = Thread(target=self.pthread)
         self.prot_thread.daemon = True
         self.prot_thread.start()
 
+        if self.pconn != self.conn:
+            self.pprot_thread = Thread(target=self.pthread, args=(True,))
+            self.pprot_thread.daemon = True
+            self.pprot_thread.start()
+
@@ -11,9 +11,11 @@ from canto_next.plugins import Plugin, PluginHandler
 from canto_next.rwlock import read_lock
 
 from .locks import sync_lock, config_lock
-from .parser import try_parse, try_eval, prep_for_display
-from .theme import FakePad, WrapPad, theme_print, theme_reset, theme_border
+from .parser import try_eval, prep_for_display
+from .theme import DisplayList, theme_print, theme_reset
 from .config import config, DEFAULT_TAG_FSTRING
+from .rendercontext import RenderContext
+from .tagcore import tag_updater, TagRegistry
 from .story import Story
 
 import traceback
@@ -31,7 +33,7 @@ log = logging.getLogger("TAG")
 class TagPlugin(Plugin):
     pass
 
-alltags = []
+alltags = TagRegistry()
 
 class Tag(PluginHandler, list):
     def __init__(self, tagcore, callbacks):
@@ -45,6 +47,8 @@ class Tag(PluginHandler, list):
 
         self.pad = None
         self.footpad = None
+        self.display = None
+        self.foot_display = None
 
         # Note that Tag() is only given the top-level CantoCursesGui
         # callbacks as it shouldn't be doing input / refreshing
@@ -95,15 +99,24 @@ class Tag(PluginHandler, list):
         self.tag_offset = 0
         self.sel_offset = 0
 
+        # Shared RenderContext, given to us by TagList.
+        self.render_ctx = None
+
+        # Sync state, our id -> Story map, the TagCore generation we've synced
+        # up to and the selected story we're keeping after its id went away.
+
+        self.stories = {}
+        self.synced_generation = -1
+        self.undead = None
+
         on_hook("curses_opt_change", self.on_opt_change, self)
         on_hook("curses_tag_opt_change", self.on_tag_opt_change, self)
-        on_hook("curses_attributes", self.on_attributes, self)
         on_hook("curses_items_added", self.on_items_added, self)
 
         # Upon creation, this Tag adds itself to the
         # list of all tags.
 
-        alltags.append(self)
+        alltags.add(self)
 
         self.sync(True)
 
@@ -119,6 +132,10 @@ class Tag(PluginHandler, list):
             s.die()
         del self[:]
 
+        tag_updater.unsubscribe(self, list(self.stories.keys()))
+        self.stories = {}
+        self.undead = None
+
         alltags.remove(self)
 
         unhook_all(self)
@@ -148,17 +165,20 @@ class Tag(PluginHandler, list):
     # change, but if we're syncing, the setting of needs_redraw isn't important
     # anymore, and if we're not, there's no issue.
 
+    # We're subscribed to attributes for all of our stories' ids, so this is
+    # only called with attributes we care about, which we pass on.
+
     def on_attributes(self, attributes):
-        for s in self:
-            if s.id in attributes:
-                self.need_redraw()
-                break
+        for id in attributes:
+            story = self.stories.get(id, None)
+            if story:
+                story.on_attributes(attributes)
+        self.need_redraw()
 
     def on_items_added(self, tagcore, added):
-        cur_ids = self.get_ids()
         if tagcore == self.tagcore:
             for story_id in added:
-                if story_id not in cur_ids:
+                if story_id not in self.stories:
                     self.updates_pending += 1
             self.need_redraw()
 
@@ -174,9 +194,7 @@ class Tag(PluginHandler, list):
         return "%s" % self.tag[self.tag.index(':') + 1:]
 
     def get_id(self, id):
-        for item in self:
-            if item.id == id:
-                return item
+        return self.stories.get(id, None)
 
     def get_ids(self):
         return [ s.id for s in self ]
@@ -233,15 +251,27 @@ class Tag(PluginHandler, list):
         self.changed = True
         self.callbacks["set_var"]("needs_redraw", True)
 
+    def set_render_context(self, ctx):
+        self.render_ctx = ctx
+
+    # Used by Tag and Story rendering. If we haven't been given a context
+    # (i.e. we're not in a TagList), make our own.
+
+    def get_render_context(self):
+        if not self.render_ctx:
+            self.render_ctx = RenderContext()
+        return self.render_ctx.current()
+
     def lines(self, width):
         if width == self.width and not self.changed:
             return self.lns
 
-        tag_conf = self.callbacks["get_opt"]("tagobj")
-        taglist_conf = self.callbacks["get_opt"]("taglist")
+        ctx = self.get_render_context()
+        taglist_conf = ctx.taglist_conf
+        tc = ctx.tag_conf(self.tag)
 
         # Values to pass on to render
-        self.collapsed = self.callbacks["get_tag_opt"]("collapsed")
+        self.collapsed = tc["collapsed"]
         self.border = taglist_conf["border"]
         self.enumerated = taglist_conf["tags_enumerated"]
         self.abs_enumerated = taglist_conf["tags_enumerated_absolute"]
@@ -253,25 +283,11 @@ class Tag(PluginHandler, list):
                 if "canto-state" not in s.content or\
                 "read" not in s.content["canto-state"]])
 
-        extra_tags = self.callbacks["get_tag_conf"](self.tag)['extra_tags']
-
-        # These are escapes that are handled in the theme_print
-        # lower in the function and should remain present after
-        # evaluation.
-
-        passthru = {}
-        for c in "RrDdUuBbSs012345678[":
-            passthru[c] = "%" + c
-
-        for attr in [ "selected", "unselected", "selected_end", "unselected_end" ]:
-            passthru[attr] = tag_conf[attr]
+        extra_tags = tc['extra_tags']
 
-        passthru['pre'] = self.pre_format
-        passthru['post'] = self.post_format
-
-        parsed = try_parse(tag_conf["format"], DEFAULT_TAG_FSTRING)
-        parsed_pre = try_parse(self.pre_format, "")
-        parsed_post = try_parse(self.post_format, "")
+        parsed = ctx.tag_parsed
+        parsed_pre = ctx.parse(self.pre_format, "")
+        parsed_post = ctx.parse(self.post_format, "")
 
         values = {  'c' : self.collapsed,
                     't' : tag,
@@ -288,7 +304,9 @@ class Tag(PluginHandler, list):
             if type(values[value]) in [str, str]:
                 values[value] = prep_for_display(values[value])
 
-        values.update(passthru)
+        # Escapes handled by theme_print, and themability variables.
+
+        values.update(ctx.tag_passthru)
 
         values["pre"] = try_eval(parsed_pre, values, "")
         values["post"] = try_eval(parsed_post, values, "")
@@ -299,8 +317,11 @@ class Tag(PluginHandler, list):
         self.width = width
         self.changed = False
 
-        self.lns = self.render_header(width, FakePad(width))
-        self.footlines = self.render_footer(width, FakePad(width))
+        self.display = DisplayList(width)
+        self.foot_display = DisplayList(width)
+
+        self.lns = self.render_header(width, self.display)
+        self.footlines = self.render_footer(width, self.foot_display)
 
         return self.lns
 
@@ -309,14 +330,15 @@ class Tag(PluginHandler, list):
             return self.lns
 
         self.pad = curses.newpad(self.lines(width), width)
-        self.render_header(width, WrapPad(self.pad))
+        self.display.blit(self.pad)
 
         if self.footlines:
             self.footpad = curses.newpad(self.footlines, width)
-            self.render_footer(width, WrapPad(self.footpad))
+            self.foot_display.blit(self.footpad)
         return self.lns
 
     def render_header(self, width, pad):
+        border = self.get_render_context().border
         s = self.evald_string
         lines = 0
 
@@ -340,8 +362,8 @@ class Tag(PluginHandler, list):
                 lines += 1
 
             if not self.collapsed and self.border:
-                theme_print(pad, theme_border("ts") * (width - 2), width,\
-                        "%B"+ theme_border("tl"), theme_border("tr") + "%b")
+                theme_print(pad, border["ts"] * (width - 2), width,\
+                        "%B"+ border["tl"], border["tr"] + "%b")
                 lines += 1
         except Exception as e:
             tb = traceback.format_exc()
@@ -354,72 +376,141 @@ class Tag(PluginHandler, list):
 
     def render_footer(self, width, pad):
         if not self.collapsed and self.border:
-            theme_print(pad, theme_border("bs") * (width - 2), width,\
-                    "%B" + theme_border("bl"), theme_border("br") + "%b")
+            border = self.get_render_context().border
+            theme_print(pad, border["bs"] * (width - 2), width,\
+                    "%B" + border["bl"], border["br"] + "%b")
             theme_reset()
             return 1
         return 0
 
-    # Synchronize this Tag with its TagCore
+    # Put our stories in TagCore order, keeping an undead story just after the
+    # last living story it followed. Must be called holding the tagcore lock.
+
+    def reorder(self):
+        ordered = [ self.stories[id] for id in self.tagcore ]
+
+        if self.undead:
+            after = -1
+            for story in self:
+                if story is self.undead:
+                    break
+                after = max(after, self.tagcore.index(story.id))
+            ordered.insert(after + 1, self.undead)
+
+        self[:] = ordered
+
+    # Synchronize this Tag with its TagCore. Normally we only look at the ids
+    # that changed since the last TagCore generation we synced to, and only
+    # reorder if we have to. If we can't get a delta (first sync, force, reset
+    # or we fell too far behind), every id is considered changed.
 
     def sync(self, force=False):
         if force or self.tagcore.changes:
-            current_stories = []
-            added_stories = []
-
             sel = self.callbacks["get_var"]("selected")
+            conf = config.get_conf()
 
             self.tagcore.lock.acquire_read()
 
             self.tagcore.ack_changes()
 
-            for story in self:
-                if story.id in self.tagcore:
-                    current_stories.append((self.tagcore.index(story.id), story))
-                elif story == sel:
+            delta = None
+            if not force:
+                delta = self.tagcore.changes_since(self.synced_generation)
+
+            if delta == None:
+                ids = list(self.stories.keys()) + list(self.tagcore)
+                moved = True
+            else:
+                ids, moved = delta
+
+            # The undead story has to be re-evaluated every sync.
 
-                    # If we preserve the selection in an "undead" state, then
-                    # we keep set tagcore changed so that the next sync operation
-                    # will re-evaluate it.
+            if self.undead:
+                ids.append(self.undead.id)
+
+            new_ids = []
+            deleted = []
+            seen = set()
 
-                    self.tagcore.changed()
+            for id in ids:
+                if id in seen:
+                    continue
+                seen.add(id)
 
-                    if current_stories:
-                        place = max([ x[0] for x in current_stories ]) + .5
+                story = self.stories.get(id, None)
+
+                if id in self.tagcore:
+                    if not story:
+                        new_ids.append(id)
                     else:
-                        place = -1
-                    current_stories.append((place, story))
+                        # Either the undead came back, or it was removed and
+                        # re-added since our last sync, either way it may not
+                        # be in the right place.
 
-            for place, id in enumerate(self.tagcore):
-                if id not in [ x[1].id for x in current_stories ]:
-                    s = Story(self, id, self.callbacks)
-                    current_stories.append((place, s))
-                    added_stories.append(s)
+                        if story is self.undead:
+                            self.undead = None
+                        moved = True
 
-            self.tagcore.lock.release_read()
+                elif story:
+                    if story == sel:
 
-            call_hook("curses_stories_added", [ self, added_stories ])
+                        # If we preserve the selection in an "undead" state,
+                        # then we keep set tagcore changed so that the next
+                        # sync operation will re-evaluate it.
+
+                        self.undead = story
+                        self.tagcore.changed()
+                    else:
+                        if story is self.undead:
+                            self.undead = None
+                        deleted.append(story)
+                        del self.stories[id]
+
+            if deleted:
+                deleted_ids = set([ s.id for s in deleted ])
+                tag_updater.unsubscribe(self, deleted_ids)
+                self[:] = [ s for s in self if s.id not in deleted_ids ]
+
+            new_ids.sort(key=self.tagcore.index)
+
+            # Subscribe before the Stories grab their initial content, so we
+            # can't miss an update in between.
+
+            tag_updater.subscribe(self, new_ids)
+
+            added_stories = []
+            for id in new_ids:
+                story = Story(self, id, self.callbacks)
+                self.stories[id] = story
+                added_stories.append(story)
+
+            # In append style new stories just go on the end, otherwise if
+            # anything has been added or moved, we take the TagCore's order.
+
+            reorder = moved or added_stories
 
-            conf = config.get_conf()
             if conf["update"]["style"] == "maintain" or self.tagcore.was_reset:
                 self.tagcore.was_reset = False
-                current_stories.sort()
+            else:
+                reorder = False
 
-            current_stories = [ x[1] for x in current_stories ]
+            if reorder:
+                self.reorder()
+            else:
+                self.extend(added_stories)
 
-            deleted = []
+            self.synced_generation = self.tagcore.generation
 
-            for story in self:
-                if not story in current_stories:
-                    deleted.append(story)
-                    story.die()
+            self.tagcore.lock.release_read()
+
+            call_hook("curses_stories_added", [ self, added_stories ])
 
             # Properly dispose of the remaining stories
 
-            call_hook("curses_stories_removed", [ self, deleted ])
+            for story in deleted:
+                story.die()
 
-            del self[:]
-            self.extend(current_stories)
+            call_hook("curses_stories_removed", [ self, deleted ])
 
             # Trigger a refresh so that classes above (i.e. TagList) will remap
             # items
@@ -10,26 +10,248 @@ from canto_next.rwlock import RWLock
 from canto_next.hooks import call_hook, on_hook
 
 from .subthread import SubThread
+from .protoloop import start_timer
 from .locks import config_lock
 from .config import config
 
+from threading import Lock
+from collections import OrderedDict
+from collections.abc import MutableMapping
 import traceback
 import logging
+import time
 
 log = logging.getLogger("TAGCORE")
 
-alltagcores = []
+# Registry of TagCores / Tags by tag name, in the order they were added. It
+# iterates, indexes and takes len() like the plain lists it replaced, but
+# finding an object by name is a dict lookup. Iteration is over a snapshot, so
+# objects can be added or removed while iterating.
+
+class TagRegistry(object):
+    def __init__(self):
+        self.by_tag = OrderedDict()
+        self.order = None
+
+    def add(self, obj):
+        self.by_tag[obj.tag] = obj
+        self.order = None
+
+    def remove(self, obj):
+        if self.by_tag.get(obj.tag) is obj:
+            del self.by_tag[obj.tag]
+            self.order = None
+
+    def get(self, tag, default=None):
+        return self.by_tag.get(tag, default)
+
+    def tags(self):
+        return list(self.by_tag.keys())
+
+    def list(self):
+        if self.order is None:
+            self.order = list(self.by_tag.values())
+        return self.order
+
+    # Accepts either a tag name or an object.
+
+    def __contains__(self, item):
+        if type(item) == str:
+            return item in self.by_tag
+        return self.by_tag.get(getattr(item, "tag", None)) is item
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __len__(self):
+        return len(self.by_tag)
+
+    def __getitem__(self, idx):
+        return self.list()[idx]
+
+    def __repr__(self):
+        return "TagRegistry(%s)" % self.tags()
+
+alltagcores = TagRegistry()
+
+# How many changes a TagCore remembers for incremental syncs. A consumer that
+# falls further behind than this just does a full sync.
+
+DELTA_LOG_SIZE = 64
+
+# Attribute requests from need_attributes() are batched into ATTRIBUTES calls
+# of at most ATTR_BATCH_SIZE ids, sent ATTR_BATCH_DELAY seconds after the first
+# one is queued, if the batch doesn't fill up before then.
+
+ATTR_BATCH_SIZE = 250
+ATTR_BATCH_DELAY = 0.05
+
+# update() keeps at most UPDATE_WINDOW ITEMS requests in flight, sending the
+# next as each ITEMSDONE comes in. Tags that are on screen and not collapsed go
+# first, so they don't wait behind every offscreen feed.
+
+UPDATE_WINDOW = 4
+
+# State / tag changes from set_attributes() are held for WRITE_DELAY seconds
+# after the last one, merged per id, so a burst of toggles only sends the final
+# state. A steady stream is still written at least every WRITE_MAX_DELAY
+# seconds, and anything pending is written on curses_exit.
+
+WRITE_DELAY = 0.2
+WRITE_MAX_DELAY = 1.0
+
+# While the GUI is consuming them (see start_staging()), ATTRIBUTES responses
+# are merged into a staging buffer and applied at frame boundaries, at most
+# update.frame_budget ids a frame, so a flood of them doesn't keep the GUI
+# waiting on our lock. If more than STAGE_LIMIT ids pile up, the protocol
+# thread applies the oldest itself.
+
+STAGE_LIMIT = 10000
+
+# We know we're going to want at least these attributes for all stories, as
+# they're part of the fallback format string.
+
+BASE_ATTRS = [ "title", "canto-state", "canto-tags", "link", "enclosures" ]
+
+# In lazy mode (update.lazy.enabled), attributes aren't sent automatically with
+# items. They're fetched for stories around the screen, and every
+# TRICKLE_INTERVAL seconds that nothing else has been requested, for
+# update.lazy.trickle more items.
+
+TRICKLE_INTERVAL = 1.0
+
+# When the attribute store goes over update.attribute_budget bytes (roughly, see
+# attr_size()), the least recently rendered entries that aren't on screen are
+# slimmed down to just the needed attributes (BASE_ATTRS, plus anything the
+# story format or search needs) until we're under EVICT_TARGET of the budget.
+# Anything else they need again is refetched the same way as in lazy mode.
+
+EVICT_TARGET = 0.9
+
+def attr_size(value):
+    if type(value) == str:
+        return len(value)
+    if type(value) in [ list, tuple ]:
+        return sum([ attr_size(v) for v in value ])
+    if type(value) in [ dict, OrderedDict, AttributeRecord ]:
+        return sum([ len(k) + attr_size(v) for (k, v) in value.items() ])
+    return 8
+
+# An AttributeRecord is one version of an item's attributes. It looks like a
+# dict, but an updated version only holds what changed and shares the rest with
+# the version it was derived from, so an update (say, a state change on an
+# item with a huge content list) doesn't copy anything. Old versions aren't
+# touched, so a Story keeps seeing the version it has until it syncs to the
+# new one. Chains are flattened every MAX_RECORD_DEPTH versions so lookups stay
+# cheap.
+
+MAX_RECORD_DEPTH = 8
+
+_deleted = object()
+
+class AttributeRecord(MutableMapping):
+    __slots__ = [ "own", "parent", "version", "depth" ]
+
+    def __init__(self, own, parent=None):
+        self.own = own
+        self.parent = parent
+        if parent is not None:
+            self.version = parent.version + 1
+            self.depth = parent.depth + 1
+        else:
+            self.version = 0
+            self.depth = 0
+
+    # Return a new version of this record with changes applied.
+
+    def derive(self, changes):
+        if self.depth < MAX_RECORD_DEPTH:
+            return AttributeRecord(changes, self)
+
+        own = dict(self.items())
+        own.update(changes)
+        r = AttributeRecord(own)
+        r.version = self.version + 1
+        return r
+
+    def __getitem__(self, key):
+        r = self
+        while r is not None:
+            if key in r.own:
+                value = r.own[key]
+                if value is _deleted:
+                    break
+                return value
+            r = r.parent
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self.own[key] = _deleted
+
+    def __iter__(self):
+        seen = set()
+        r = self
+        while r is not None:
+            for key, value in r.own.items():
+                if key not in seen:
+                    seen.add(key)
+                    if value is not _deleted:
+                        yield key
+            r = r.parent
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        return dict(self.items())
+
+# TagCore is an ordered list of ids, with an id -> position index on the side
+# so that membership (id in tagcore) and tagcore.index(id) are O(1) and bulk
+# adds / removes are linear. It's still a list, so everything that reads it
+# like one keeps working, but changes must go through add_items(),
+# remove_items(), update_items() and reset() to keep the index consistent.
+
+# Every change also bumps the generation and is logged, so a Tag can ask what
+# changed since the last generation it saw (see changes_since()) instead of
+# comparing itself against the whole list.
 
 class TagCore(list):
     def __init__(self, tag):
         list.__init__(self)
         self.tag = tag
 
+        self.positions = {}
+
+        self.generation = 0
+        self.delta_log = []
+        self.reset_generation = 0
+
         self.changes = False
         self.was_reset = False
 
         self.lock = RWLock("lock: %s" % tag)
-        alltagcores.append(self)
+        alltagcores.add(self)
+
+    def __contains__(self, id):
+        return id in self.positions
+
+    def index(self, id, *args):
+        if args:
+            return list.index(self, id, *args)
+        try:
+            return self.positions[id]
+        except KeyError:
+            raise ValueError("%s is not in tagcore %s" % (id, self.tag))
+
+    def _reindex(self):
+        self.positions = dict([ (id, i) for (i, id) in enumerate(self) ])
 
     # change functions must be called holding lock
 
@@ -39,14 +261,46 @@ class TagCore(list):
     def changed(self):
         self.changes = True
 
+    def _log_delta(self, ids, moved):
+        self.generation += 1
+        self.delta_log.append((self.generation, ids, moved))
+        if len(self.delta_log) > DELTA_LOG_SIZE:
+            del self.delta_log[0]
+
+    # Return (ids, moved) where ids is every id added or removed since
+    # generation, and moved is whether anything was reordered, or None if we
+    # can't tell (we've been reset, or the log doesn't go back that far).
+    # Must be called holding lock.
+
+    def changes_since(self, generation):
+        if generation < self.reset_generation:
+            return None
+        if generation == self.generation:
+            return ([], False)
+        if not self.delta_log or self.delta_log[0][0] > generation + 1:
+            return None
+
+        ids = []
+        moved = False
+        for gen, delta_ids, delta_moved in self.delta_log:
+            if gen > generation:
+                ids.extend(delta_ids)
+                moved |= delta_moved
+        return (ids, moved)
+
     def add_items(self, ids):
         self.lock.acquire_write()
 
         added = []
         for id in ids:
-            self.append(id)
+            if id in self.positions:
+                continue
+            self.positions[id] = len(self)
+            list.append(self, id)
             added.append(id)
 
+        self._log_delta(added, False)
+
         call_hook("curses_items_added", [ self, added ] )
 
         self.changed()
@@ -55,23 +309,63 @@ class TagCore(list):
     def remove_items(self, ids):
         self.lock.acquire_write()
 
-        removed = []
+        ids = set(ids)
 
-        # Copy self so we can remove from self
-        # without screwing up iteration.
+        removed = []
+        kept = []
 
-        for idx, id in enumerate(self[:]):
+        for id in self:
             if id in ids:
                 log.debug("removing: %s" % (id,))
-
-                list.remove(self, id)
                 removed.append(id)
+            else:
+                kept.append(id)
+
+        if removed:
+            self[:] = kept
+            self._reindex()
+
+        self._log_delta(removed, False)
 
         call_hook("curses_items_removed", [ self, removed ] )
 
         self.changed()
         self.lock.release_write()
 
+    # Apply a whole ITEMS response in one step. order is the complete list of
+    # ids in the daemon's order, added and removed are the difference between
+    # that and our current contents, as computed by TagUpdater. Anything left
+    # over that's out of place has moved, so we just take the daemon's order.
+
+    def update_items(self, order, added, removed):
+        self.lock.acquire_write()
+
+        # Only count it as moved if the ids we're keeping changed order.
+
+        if added or removed:
+            addset = set(added)
+            remset = set(removed)
+            moved = [ id for id in order if id not in addset ] !=\
+                    [ id for id in self if id not in remset ]
+        else:
+            moved = list.__ne__(self, order)
+
+        if added or removed or moved:
+            self[:] = order
+            self._reindex()
+            self._log_delta(added + removed, moved)
+            self.changed()
+
+        if added:
+            call_hook("curses_items_added", [ self, added ] )
+
+        if removed:
+            for id in removed:
+                log.debug("removing: %s" % (id,))
+            call_hook("curses_items_removed", [ self, removed ] )
+
+        self.lock.release_write()
+
     # Remove all stories from this tag.
 
     def reset(self):
@@ -87,6 +381,11 @@ class TagCore(list):
         if len(self):
             call_hook("curses_items_removed", [ self, self[:] ])
         del self[:]
+        self.positions = {}
+
+        self.generation += 1
+        self.reset_generation = self.generation
+        self.delta_log = []
 
         self.changed()
         self.lock.release_write()
@@ -95,26 +394,64 @@ class TagUpdater(SubThread):
     def init(self, backend):
         SubThread.init(self, backend)
 
-        self.item_tag = None
-        self.item_buf = []
-        self.item_removes = []
-        self.item_adds = []
+        self.reset_items()
 
-        self.attributes = {}
+        self.attributes = OrderedDict()
         self.lock = RWLock("tagupdater")
 
+        # Attribute store accounting, for eviction.
+        self.attr_sizes = {}
+        self.attr_bytes = 0
+        self.pinned = set()
+        self.evicted = set()
+        self.attr_stats = { "evictions" : 0, "evicted_bytes" : 0,
+                "refetches" : 0 }
+
+        # id -> objects subscribed to its attribute updates
+        self.subscribers = {}
+
+        # Staged ATTRIBUTES, the GUI's callback to get a frame when there's
+        # something new, and ids someone is waiting on (go to the front).
+        self.staged = OrderedDict()
+        self.stage_release = None
+        self.stage_lock = Lock()
+        self.apply_lock = Lock()
+        self.urgent = set()
+
+        # Batched attribute requests
+        self.attr_requests = {}
+        self.attr_timer = None
+        self.attr_lock = Lock()
+
+        # Write-behind SETATTRIBUTES
+        self.pending_writes = {}
+        self.write_timer = None
+        self.write_started = 0
+        self.write_lock = Lock()
+
+        on_hook("curses_exit", self.flush_writes)
+
+        self.lazy = config.get_opt("update.lazy.enabled")
+        self.trickle_timer = None
+        self.trickle_pos = (0, 0)
+
         # Response counters
         self.discard = 0
         self.still_updating = 0
 
+        # Update scheduling, tags waiting to be requested, in flight (tag ->
+        # time requested), and how long each tag's last refresh took.
+        self.update_queue = OrderedDict()
+        self.update_inflight = OrderedDict()
+        self.update_started = 0
+        self.update_latency = {}
+        self.update_lock = Lock()
+
         self.start_pthread()
 
         # Setup automatic attributes.
 
-        # We know we're going to want at least these attributes for
-        # all stories, as they're part of the fallback format string.
-
-        self.needed_attrs = [ "title", "canto-state", "canto-tags", "link", "enclosures" ]
+        self.needed_attrs = BASE_ATTRS[:]
 
         # Make sure we grab attributes needed for the story
         # format and story format.
@@ -127,7 +464,8 @@ class TagUpdater(SubThread):
                 if sa not in self.needed_attrs:
                     self.needed_attrs.append(sa)
 
-        self.write("AUTOATTR", self.needed_attrs)
+        if not self.lazy:
+            self.write("AUTOATTR", self.needed_attrs)
 
         # Lock config_lock so that strtags doesn't change and we miss
         # tags.
@@ -147,6 +485,7 @@ class TagUpdater(SubThread):
         on_hook("curses_del_tag", self.on_del_tag)
         on_hook("curses_stories_removed", self.on_stories_removed)
         on_hook("curses_def_opt_change", self.on_def_opt_change)
+        on_hook("curses_opt_change", self.on_opt_change)
 
         config_lock.release_read()
 
@@ -155,29 +494,40 @@ class TagUpdater(SubThread):
         call_hook("curses_new_tagcore", [ TagCore(tag) ])
 
     def on_del_tag(self, tag):
-        for tagcore in alltagcores:
-            if tagcore.tag == tag:
-                tagcore.reset()
-                call_hook("curses_del_tagcore", [ tagcore ])
-                return
+        tagcore = alltagcores.get(tag)
+        if tagcore is not None:
+            tagcore.reset()
+            call_hook("curses_del_tagcore", [ tagcore ])
+            alltagcores.remove(tagcore)
+
+        # Don't wait on a refresh for it, the ITEMSDONE might not come, and if
+        # it does it won't be counted.
+
+        self.update_lock.acquire()
+        self.update_queue.pop(tag, None)
+        if self.update_inflight.pop(tag, None) is not None:
+            self.send_updates()
+        complete = self.count_updates()
+        self.update_lock.release()
+
+        if complete:
+            self.update_complete()
 
     # Once they've been removed from the GUI, their attributes can be forgotten
     def on_stories_removed(self, tag, items):
-        tagcore = None
-        for tc in alltagcores:
-            if tc.tag == tag.tag:
-                tagcore = tc
-                break
-        else:
-            log.warn("Couldn't find tagcore for removed story tag %s" % tag.tag)
+        # No tagcore means the tag was deleted, so nothing is keeping these.
+
+        tagcore = alltagcores.get(tag.tag)
 
         self.lock.acquire_write()
         for item in items:
-            if tagcore and item.id in tc:
+            if tagcore is not None and item.id in tagcore:
                 log.debug("%s still in tagcore, not removing" % item.id)
                 continue
             if item.id in self.attributes:
                 del self.attributes[item.id]
+                self.attr_bytes -= self.attr_sizes.pop(item.id)
+                self.evicted.discard(item.id)
         self.lock.release_write()
 
     # Changes to global filters should force a full refresh.
@@ -188,27 +538,262 @@ class TagUpdater(SubThread):
             self.reset(True)
             self.update()
 
+    # Lazy mode can be switched at runtime. The daemon has to be told whether
+    # to keep following ITEMS with attributes, and the trickle stops on its own
+    # (see trickle_attributes()).
+
+    def on_opt_change(self, conf):
+        if "update" not in conf or "lazy" not in conf["update"]:
+            return
+
+        lazy = config.get_opt("update.lazy.enabled")
+        if lazy == self.lazy:
+            return
+
+        self.lock.acquire_read()
+        self.lazy = lazy
+        if lazy:
+            self.write("AUTOATTR", [])
+        else:
+            self.write("AUTOATTR", self.needed_attrs)
+        self.lock.release_read()
+
     def prot_attributes(self, d):
         if self.discard:
             return
 
+        # After an AUTOATTR [], the daemon still follows ITEMS with an empty
+        # set of attributes for every item. There's nothing to apply.
+
+        d = dict([ (k, v) for (k, v) in d.items() if v ])
+        if not d:
+            return
+
         # Update attributes, and then notify everyone to grab new content.
+        # Subscribers only get the ids they asked for, everyone else gets
+        # every id that changed, but never the whole store.
+
+        # Don't let a response that was in flight before we wrote a change
+        # revert it. The change is already reflected in the story.
+
+        self.write_lock.acquire()
+        for key in d.keys():
+            if key in self.pending_writes:
+                overlay = dict(d[key])
+                for k, v in self.pending_writes[key].items():
+                    if k in overlay:
+                        overlay[k] = v
+                d[key] = overlay
+        self.write_lock.release()
+
+        if self.stage_release:
+            self.stage_attributes(d)
+        else:
+            self.apply_attributes(d)
+
+    def apply_attributes(self, d):
         self.lock.acquire_write()
 
+        changed = {}
+
         for key in d.keys():
             if key in self.attributes:
 
-                # If we're updating, we want to create a whole new dict object
-                # so that our stories dicts don't get updated without a sync
+                # If we're updating, we want a new version so that our stories
+                # don't see the change without a sync. Only the changed
+                # attributes count towards the change in size.
+
+                old = self.attributes[key]
+                size = self.attr_sizes[key]
+                for k, v in d[key].items():
+                    if k in old:
+                        size -= len(k) + attr_size(old[k])
+                    size += len(k) + attr_size(v)
+
+                self.attributes[key] = old.derive(d[key])
+            else:
+                self.attributes[key] = AttributeRecord(d[key])
+                size = attr_size(d[key])
+
+            self.attr_bytes += size - self.attr_sizes.get(key, 0)
+            self.attr_sizes[key] = size
+
+            if key in self.evicted:
+                self.evicted.discard(key)
+                self.attr_stats["refetches"] += 1
+
+            changed[key] = self.attributes[key]
+
+        # Slimmed entries only concern their stories.
+
+        slimmed = self.enforce_budget()
+        slimmed.update(changed)
+
+        targets = self.subscribed(slimmed)
+
+        self.lock.release_write()
+
+        for obj, attributes in targets:
+            obj.on_attributes(attributes)
+
+        call_hook("curses_attributes", [ changed ])
+
+    # Have ATTRIBUTES responses staged, and call release() when there are
+    # staged updates for apply_staged() to apply.
+
+    def start_staging(self, release):
+        self.stage_release = release
+
+    def stop_staging(self):
+        self.stage_release = None
+        while self.apply_staged(STAGE_LIMIT):
+            pass
+
+    def stage_attributes(self, d):
+        self.stage_lock.acquire()
+
+        was_empty = not self.staged
+
+        for key, attrs in d.items():
+            if key in self.staged:
+                self.staged[key].update(attrs)
+            else:
+                self.staged[key] = dict(attrs)
+
+            if key in self.urgent:
+                self.urgent.discard(key)
+                self.staged.move_to_end(key, last=False)
+
+        overflow = len(self.staged) - STAGE_LIMIT
+
+        self.stage_lock.release()
+
+        if overflow > 0:
+            self.apply_staged(overflow)
+
+        if was_empty:
+            self.stage_release()
+
+    # Apply up to budget staged updates (0 for no limit), oldest (or most
+    # urgent) first. Returns how many are still staged.
+
+    def apply_staged(self, budget):
+        if not budget:
+            budget = STAGE_LIMIT
+
+        self.apply_lock.acquire()
+
+        self.stage_lock.acquire()
+        batch = {}
+        while self.staged and len(batch) < budget:
+            key, attrs = self.staged.popitem(last=False)
+            batch[key] = attrs
+        remaining = len(self.staged)
+        self.stage_lock.release()
+
+        if batch:
+            self.apply_attributes(batch)
+
+        self.apply_lock.release()
+
+        return remaining
+
+    # Return [ (obj, { id : attributes }) ] for every subscriber to any of the
+    # ids in attributes. Must be called holding lock.
+
+    def subscribed(self, attributes):
+        targets = {}
+        for key in attributes:
+            for obj in self.subscribers.get(key, []):
+                if id(obj) not in targets:
+                    targets[id(obj)] = (obj, {})
+                targets[id(obj)][1][key] = attributes[key]
+        return list(targets.values())
+
+    # Slim down least recently rendered entries until we're back under budget.
+    # Returns the slimmed entries. Must be called holding write lock.
+
+    def enforce_budget(self):
+        budget = config.get_opt("update.attribute_budget")
+        if not budget or self.attr_bytes <= budget:
+            return {}
+
+        target = budget * EVICT_TARGET
+        keep = set(self.needed_attrs)
+        slimmed = {}
+
+        for key, attrs in self.attributes.items():
+            if self.attr_bytes <= target:
+                break
+            if key in self.pinned:
+                continue
+
+            slim = dict([ (k, v) for (k, v) in attrs.items() if k in keep ])
+            if len(slim) == len(attrs):
+                continue
+            slim = AttributeRecord(slim)
+
+            size = attr_size(slim)
+            freed = self.attr_sizes[key] - size
+
+            self.attributes[key] = slim
+            self.attr_sizes[key] = size
+            self.attr_bytes -= freed
+            self.evicted.add(key)
+
+            self.attr_stats["evictions"] += 1
+            self.attr_stats["evicted_bytes"] += freed
+
+            slimmed[key] = slim
+
+        log.debug("Evicted %d attribute entries, store at %d bytes" %\
+                (len(slimmed), self.attr_bytes))
+
+        return slimmed
+
+    # Mark ids as just rendered, and protect them from eviction until the next
+    # call.
+
+    def touch_attributes(self, ids):
+        self.lock.acquire_write()
+        for key in ids:
+            if key in self.attributes:
+                self.attributes.move_to_end(key)
+        self.pinned = set(ids)
+        self.lock.release_write()
+
+    def get_attribute_stats(self):
+        self.lock.acquire_read()
+        stats = self.attr_stats.copy()
+        stats["entries"] = len(self.attributes)
+        stats["bytes"] = self.attr_bytes
+        stats["evicted"] = len(self.evicted)
+        self.lock.release_read()
+        return stats
 
-                cp = self.attributes[key].copy()
-                cp.update(d[key])
-                self.attributes[key] = cp
+    # Subscribe obj to attribute updates for ids. Its on_attributes() will be
+    # called with just the subscribed ids that changed.
+
+    def subscribe(self, obj, ids):
+        self.lock.acquire_write()
+        for i in ids:
+            if i in self.subscribers:
+                self.subscribers[i].append(obj)
             else:
-                self.attributes[key] = d[key]
+                self.subscribers[i] = [ obj ]
         self.lock.release_write()
 
-        call_hook("curses_attributes", [ self.attributes ])
+    def unsubscribe(self, obj, ids):
+        self.lock.acquire_write()
+        for i in ids:
+            if i not in self.subscribers:
+                continue
+            subs = [ o for o in self.subscribers[i] if o is not obj ]
+            if subs:
+                self.subscribers[i] = subs
+            else:
+                del self.subscribers[i]
+        self.lock.release_write()
 
     def prot_items(self, updates):
         if self.discard:
@@ -218,61 +803,62 @@ class TagUpdater(SubThread):
 
         tag = list(updates.keys())[0]
 
-        if self.item_tag == None or self.item_tag.tag != tag:
-            self.item_tag = None
-            self.item_buf = []
-            self.item_removes = []
-            self.item_adds = []
-            for have_tag in alltagcores:
-                if have_tag.tag == tag:
-                    self.item_tag = have_tag
-                    break
+        if self.item_name != tag:
+            self.reset_items()
+            self.item_name = tag
+            self.item_tag = alltagcores.get(tag)
 
-            # Shouldn't happen
-            else:
-                return
+        # The tag was deleted, but we still want its ITEMSDONE.
+
+        if self.item_tag == None:
+            return
 
-        self.item_buf.extend(updates[tag])
+        # Build up the new order, and what's new in it, as the chunks come in
+        # so ITEMSDONE only has to find what's gone.
 
-        # Add new items.
         for id in updates[tag]:
+            if id in self.item_seen:
+                continue
+            self.item_seen.add(id)
+            self.item_buf.append(id)
             if id not in self.item_tag:
                 self.item_adds.append(id)
 
-    def prot_itemsdone(self, empty):
-        if self.item_tag == None:
-            return
+    def reset_items(self):
+        self.item_name = None
+        self.item_tag = None
+        self.item_buf = []
+        self.item_seen = set()
+        self.item_adds = []
 
+    def prot_itemsdone(self, empty):
         if self.discard:
-            self.item_tag = None
-            self.item_buf = []
-            self.item_removes = []
-            self.item_adds = []
+            self.reset_items()
             return
 
-        if self.item_adds:
-            self.item_tag.add_items(self.item_adds)
+        if self.item_tag == None:
+            tag = self.item_name
+            self.reset_items()
+            if tag != None:
+                self.update_done(tag)
+            return
 
         # Eliminate discarded items. This has to be done here, so we have
         # access to all of the items given in the multiple ITEM responses.
 
-        for id in self.item_tag:
-            if id not in self.item_buf:
-                self.item_removes.append(id)
+        self.item_tag.lock.acquire_read()
+        removes = [ id for id in self.item_tag if id not in self.item_seen ]
+        self.item_tag.lock.release_read()
 
-        if self.item_removes:
-            self.item_tag.remove_items(self.item_removes)
+        self.item_tag.update_items(self.item_buf, self.item_adds, removes)
 
-        self.item_tag = None
-        self.item_buf = []
-        self.item_removes = []
-        self.item_adds = []
+        if self.lazy and self.item_adds:
+            self.start_trickle()
+
+        tag = self.item_tag.tag
+        self.reset_items()
 
-        if self.still_updating:
-            self.still_updating -= 1
-            if not self.still_updating:
-                log.debug("Calling curses_update_complete")
-                call_hook("curses_update_complete", [])
+        self.update_done(tag)
 
     def prot_tagchange(self, tag):
         self.write("ITEMS", [ tag ])
@@ -283,16 +869,103 @@ class TagUpdater(SubThread):
     # The following is the external interface to tagupdater.
 
     def update(self):
-        strtags = config.get_var("strtags")
-        for tag in strtags:
+        # Make sure the daemon has our state before it filters items.
+        self.flush_writes(False)
+
+        self.update_lock.acquire()
+
+        if not self.still_updating:
+            self.update_started = time.time()
+
+        for tag in config.get_var("strtags"):
+            if tag not in self.update_queue:
+                self.update_queue[tag] = None
+
+        # Visible, uncollapsed tags go to the front of the queue, in the order
+        # they're shown.
+
+        visible = [ t.tag for t in config.get_var("taglist_visible_tags")\
+                if not t.collapsed ]
+
+        for tag in reversed(visible):
+            if tag in self.update_queue:
+                self.update_queue.move_to_end(tag, last=False)
+
+        self.still_updating = len(self.update_queue) + len(self.update_inflight)
+
+        self.send_updates()
+
+        self.update_lock.release()
+
+    # Fill the window. Call with update_lock held.
+
+    def send_updates(self):
+        while self.update_queue and len(self.update_inflight) < UPDATE_WINDOW:
+            tag = self.update_queue.popitem(last=False)[0]
+            self.update_inflight[tag] = time.time()
             self.write("ITEMS", [ tag ])
-            self.still_updating += 1
+
+    # An ITEMSDONE for tag came in. If it was one of ours, record how long it
+    # took and request the next one. Tags requested some other way (i.e.
+    # prot_tagchange) don't count.
+
+    def update_done(self, tag):
+        self.update_lock.acquire()
+
+        if tag not in self.update_inflight:
+            self.update_lock.release()
+            return
+
+        now = time.time()
+        self.update_latency[tag] = now - self.update_inflight.pop(tag)
+        log.debug("Refreshed %s in %.3fs" % (tag, self.update_latency[tag]))
+
+        self.send_updates()
+        complete = self.count_updates()
+
+        self.update_lock.release()
+
+        if complete:
+            self.update_complete()
+
+    # Recount what's left of the update, returning whether that finished it.
+    # Call with update_lock held.
+
+    def count_updates(self):
+        was_updating = self.still_updating
+        self.still_updating = len(self.update_queue) + len(self.update_inflight)
+        return was_updating and not self.still_updating
+
+    def update_complete(self):
+        log.debug("Update finished in %.3fs" % (time.time() - self.update_started))
+        log.debug("Calling curses_update_complete")
+        call_hook("curses_update_complete", [])
+
+    # Per-tag latency of the most recent refresh, slowest first.
+
+    def get_update_stats(self):
+        self.update_lock.acquire()
+        r = sorted(self.update_latency.items(), key=lambda x : x[1], reverse=True)
+        self.update_lock.release()
+        return r
 
     def reset(self, force=False):
         if self.still_updating and not force:
             log.debug("Not initiating refresh, update still in progress")
             return False
 
+        # Anything still in flight will be discarded along with the rest.
+
+        self.stage_lock.acquire()
+        self.staged = OrderedDict()
+        self.stage_lock.release()
+
+        self.update_lock.acquire()
+        self.update_queue = OrderedDict()
+        self.update_inflight = OrderedDict()
+        self.still_updating = 0
+        self.update_lock.release()
+
         for tag in alltagcores:
             tag.reset()
         self.discard += 1
@@ -316,15 +989,59 @@ class TagUpdater(SubThread):
 
     # This takes a fat argument because callers need to be able to curry
     # together multiple sets so stuff like 'item-state read *' don't generate
-    # thousands of SETATTRIBUTES calls and take forever
+    # thousands of SETATTRIBUTES calls and take forever. Changes are queued and
+    # merged, see WRITE_DELAY.
 
     def set_attributes(self, arg):
-        self.lock.acquire_write()
-        self.write("SETATTRIBUTES", arg)
-        self.lock.release_write()
+        self.write_lock.acquire()
+
+        for id, attrs in arg.items():
+            if id in self.pending_writes:
+                self.pending_writes[id].update(attrs)
+            else:
+                self.pending_writes[id] = dict(attrs)
+
+        now = time.time()
+
+        if self.write_timer:
+            self.write_timer.cancel()
+        else:
+            self.write_started = now
+
+        # Writes happen under write_lock, so batches can't be reordered.
+
+        if now - self.write_started >= WRITE_MAX_DELAY:
+            self.write("SETATTRIBUTES", self.pending_writes, True)
+            self.pending_writes = {}
+            self.write_timer = None
+        else:
+            self.write_timer = start_timer(WRITE_DELAY, self.flush_writes)
+
+        self.write_lock.release()
+
+    # Write any pending changes now. This is called from the timer, and on
+    # curses_exit, while the daemon connection is still up. update() flushes
+    # over the bulk lane, so the changes are ordered before its ITEMS.
+
+    def flush_writes(self, priority=True):
+        self.write_lock.acquire()
+        if self.write_timer:
+            self.write_timer.cancel()
+            self.write_timer = None
+        if self.pending_writes:
+            self.write("SETATTRIBUTES", self.pending_writes, priority)
+            self.pending_writes = {}
+        self.write_lock.release()
+
+    # For things the user is waiting on (i.e. the reader), so it goes over the
+    # priority lane.
 
     def request_attributes(self, id, attrs):
-        self.write("ATTRIBUTES", { id : attrs })
+        self.stage_lock.acquire()
+        self.urgent.add(id)
+        self.stage_lock.release()
+
+        self.write("ATTRIBUTES", { id : attrs }, True)
 
     def need_attributes(self, id, attrs):
         self.lock.acquire_write()
@@ -339,13 +1056,123 @@ class TagUpdater(SubThread):
 
         if updated:
             self.needed_attrs = needed
-            self.write("AUTOATTR", self.needed_attrs)
+            if not self.lazy:
+                self.write("AUTOATTR", self.needed_attrs)
 
         self.lock.release_write()
 
         # Even if we didn't update this time, make sure we attempt to get this
         # id's new needed attributes.
 
-        self.write("ATTRIBUTES", { id : needed })
+        self.queue_attributes(id, needed)
+
+    def queue_attributes(self, id, attrs):
+        batch = None
+
+        self.attr_lock.acquire()
+
+        if id in self.attr_requests:
+            queued = self.attr_requests[id]
+            for attr in attrs:
+                if attr not in queued:
+                    queued.append(attr)
+        else:
+            self.attr_requests[id] = attrs[:]
+
+        if len(self.attr_requests) >= ATTR_BATCH_SIZE:
+            batch = self.attr_requests
+            self.attr_requests = {}
+        elif not self.attr_timer:
+            self.attr_timer = start_timer(ATTR_BATCH_DELAY, self.flush_attributes)
+
+        self.attr_lock.release()
+
+        if batch:
+            self.write("ATTRIBUTES", batch)
+
+    # Request needed attributes for any of ids that don't have them all. This is
+    # how stories get attributes in lazy mode.
+
+    def prefetch_attributes(self, ids):
+        self.lock.acquire_read()
+        needed = self.needed_attrs
+        missing = []
+        for id in ids:
+            if id in self.staged:
+                continue
+            if id not in self.attributes:
+                missing.append(id)
+                continue
+            have = self.attributes[id]
+            for attr in needed:
+                if attr not in have:
+                    missing.append(id)
+                    break
+        self.lock.release_read()
+
+        for id in missing:
+            self.queue_attributes(id, needed)
+
+        return len(missing)
+
+    def start_trickle(self):
+        self.attr_lock.acquire()
+        if not self.trickle_timer:
+            self.trickle_pos = (0, 0)
+            self.trickle_timer = start_timer(TRICKLE_INTERVAL, self.trickle_attributes)
+        self.attr_lock.release()
+
+    # Walk the tagcores from where we left off, prefetching the next batch of
+    # items. When we run off the end, we stop until more items show up.
+
+    def trickle_attributes(self):
+        self.attr_lock.acquire()
+        if not self.lazy:
+            self.trickle_timer = None
+            self.attr_lock.release()
+            return
+        busy = self.attr_requests != {}
+        self.attr_lock.release()
+
+        if not busy:
+            count = config.get_opt("update.lazy.trickle")
+            tc_idx, pos = self.trickle_pos
+            requested = 0
+
+            while tc_idx < len(alltagcores) and requested < count:
+                tagcore = alltagcores[tc_idx]
+                tagcore.lock.acquire_read()
+                chunk = tagcore[pos:pos + count]
+                tagcore.lock.release_read()
+
+                requested += self.prefetch_attributes(chunk)
+
+                if len(chunk) and pos + len(chunk) < len(tagcore):
+                    pos += len(chunk)
+                else:
+                    tc_idx += 1
+                    pos = 0
+
+            self.trickle_pos = (tc_idx, pos)
+
+            if not requested:
+                self.attr_lock.acquire()
+                self.trickle_timer = None
+                self.attr_lock.release()
+                return
+
+        self.attr_lock.acquire()
+        self.trickle_timer = start_timer(TRICKLE_INTERVAL, self.trickle_attributes)
+        self.attr_lock.release()
+
+    def flush_attributes(self):
+        self.attr_lock.acquire()
+        batch = self.attr_requests
+        self.attr_requests = {}
+        self.attr_timer = None
+        self.attr_lock.release()
+
+        if batch:
+            self.write("ATTRIBUTES", batch)
 
 tag_updater = TagUpdater()
@@ -11,9 +11,11 @@ from canto_next.plugins import Plugin
 
 from .command import register_commands, register_arg_types, unregister_all, _int_range, _int_check, _string
 from .tagcore import tag_updater, alltagcores
+from .rendercontext import RenderContext
 from .locks import config_lock
 from .guibase import GuiBase
 from .reader import Reader
+from .story import livestories
 from .tag import Tag, alltags
 
 import logging
@@ -53,6 +55,18 @@ class TagList(GuiBase):
 
         self.tags = []
 
+        # Config derived render information, shared with all of our Tags and
+        # their Stories.
+
+        self.render_ctx = RenderContext()
+
+        # Incremented every redraw, to tell which Stories are still wanted.
+        self.frame = 0
+
+        # Item offset of the top of the screen last redraw, to tell which way
+        # we're scrolling.
+        self.last_top = 0
+
         # Hold config log so we don't miss any new TagCores or get updates
         # before we're ready.
 
@@ -62,10 +76,7 @@ class TagList(GuiBase):
         # Keep in mind TagList may be instantiated more than once.
 
         for tagcore in alltagcores:
-            for tagobj in alltags:
-                if tagobj.tag == tagcore.tag:
-                    break
-            else:
+            if tagcore.tag not in alltags:
                 log.debug("Instantiating Tag() for %s" % tagcore.tag)
                 Tag(tagcore, self.callbacks)
 
@@ -294,9 +305,9 @@ class TagList(GuiBase):
 
     def on_del_tagcore(self, tagcore):
         log.debug("taglist on_del_tag")
-        for tagobj in alltags:
-            if tagobj.tag == tagcore.tag:
-                tagobj.die()
+        tagobj = alltags.get(tagcore.tag)
+        if tagobj is not None:
+            tagobj.die()
 
         self.callbacks["set_var"]("needs_refresh", True)
 
@@ -858,7 +869,7 @@ class TagList(GuiBase):
         if not category:
             return
         for tag in tags:
-            tc = self.callbacks["get_tag_conf"](tag.tag)
+            tc = self.callbacks["copy_tag_conf"](tag.tag)
 
             fullcat = "category:" + category
             if fullcat not in tc["extra_tags"]:
@@ -870,7 +881,7 @@ class TagList(GuiBase):
         if not category:
             return
         for tag in tags:
-            tc = self.callbacks["get_tag_conf"](tag.tag)
+            tc = self.callbacks["copy_tag_conf"](tag.tag)
 
             fullcat = "category:" + category
             if fullcat in tc["extra_tags"]:
@@ -923,9 +934,10 @@ class TagList(GuiBase):
         # Make sure to honor the order of tags in curtags.
 
         for tag in curtags:
-            for tagobj in alltags:
-                if tagobj.tag == tag:
-                    self.tags.append(tagobj)
+            tagobj = alltags.get(tag)
+            if tagobj is not None:
+                tagobj.set_render_context(self.render_ctx)
+                self.tags.append(tagobj)
 
         hide_empty = self.callbacks["get_opt"]("taglist.hide_empty_tags")
 
@@ -978,6 +990,8 @@ class TagList(GuiBase):
 
         log.debug("Taglist REFRESH!\n")
 
+        self.render_ctx.current()
+
         self.update_tag_lists()
         self.update_target_obj()
 
@@ -1084,6 +1098,8 @@ class TagList(GuiBase):
 
     def redraw(self):
         log.debug("Taglist REDRAW (%s)!\n" % self.width)
+
+        self.render_ctx.current()
         self.pad.erase()
 
         target_obj = self.callbacks["get_var"]("target_obj")
@@ -1193,6 +1209,7 @@ class TagList(GuiBase):
 
         rendered_header = False
         w_offset = 0
+        first_obj = obj
 
         while obj != None:
             # Refresh if necessary, update curpos for scrolling.
@@ -1241,8 +1258,82 @@ class TagList(GuiBase):
 
             obj = obj.next_obj
 
+        self.update_live(first_obj, obj)
+
         self.callbacks["refresh"]()
 
+    # Keep Stories materialized from margin objects before the first object on
+    # screen to margin objects after the last, and recycle any others.
+
+    def update_live(self, first_obj, last_obj):
+        self.frame += 1
+
+        margin = self.render_ctx.taglist_conf["story_margin"]
+
+        obj = first_obj
+        for i in range(margin):
+            if not obj.prev_obj:
+                break
+            obj = obj.prev_obj
+
+        remaining = None
+        while obj and remaining != 0:
+            if not obj.is_tag:
+                obj.materialize()
+                obj.live_frame = self.frame
+
+            if remaining != None:
+                remaining -= 1
+            elif obj is last_obj:
+                remaining = margin
+
+            obj = obj.next_obj
+
+        # In lazy mode, also grab attributes for the next prefetch items in
+        # the direction we're scrolling.
+
+        if self.callbacks["get_opt"]("update.lazy.enabled"):
+            if first_obj.is_tag:
+                top = first_obj.item_offset
+            else:
+                top = first_obj.offset
+
+            if top < self.last_top:
+                obj = first_obj
+                for i in range(margin):
+                    if not obj.prev_obj:
+                        break
+                    obj = obj.prev_obj
+                attr = "prev_obj"
+            else:
+                attr = "next_obj"
+
+            self.last_top = top
+
+            ids = []
+            for i in range(self.callbacks["get_opt"]("update.lazy.prefetch")):
+                if not obj:
+                    break
+                if not obj.is_tag:
+                    ids.append(obj.id)
+                obj = getattr(obj, attr)
+
+            tag_updater.prefetch_attributes(ids)
+
+        live = []
+        for story in livestories:
+            if not story.live:
+                continue
+            if story.live_frame == self.frame:
+                live.append(story)
+            else:
+                story.recycle()
+        livestories[:] = live
+
+        # Keep the attributes of everything live from being evicted.
+
+        tag_updater.touch_attributes([ story.id for story in live ])
+
     def is_input(self):
         return False
 
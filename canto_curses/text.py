@@ -8,7 +8,7 @@
 
 from canto_next.hooks import on_hook, unhook_all
 
-from .theme import FakePad, WrapPad, theme_print, theme_lstrip, theme_border, theme_reset
+from .theme import DisplayList, WrapPad, theme_print, theme_lstrip, theme_border, theme_reset
 from .command import register_commands, unregister_command
 from .guibase import GuiBase
 from .theme import theme_print
@@ -53,12 +53,12 @@ class TextBox(GuiBase):
     def refresh(self):
         self.height, self.width = self.pad.getmaxyx()
 
-        fp = FakePad(self.width)
-        lines = self.render(fp)
+        display = DisplayList(self.width)
+        lines = self.render(display)
 
         # Create pre-rendered pad
         self.fullpad = curses.newpad(lines, self.width)
-        self.render(WrapPad(self.fullpad))
+        display.blit(self.fullpad)
 
         # Update offset based on new display properties.
         self.max_offset = max((lines - 1) - (self.height - 1), 0)
@@ -7,7 +7,9 @@
 #   published by the Free Software Foundation.
 
 from canto_next.encoding import encoder, locale_enc
-from .widecurse import waddch, wcwidth
+from .widecurse import waddch, waddnwstr, wcwidth, char_widths, str_width, prefix_widths
+from .widecurse import theme_print as native_theme_print
+from .widecurse import theme_len as native_theme_len
 
 import curses
 
@@ -34,13 +36,37 @@ attr_map = { "B" : curses.A_BOLD,
 color_stack = []
 color_stack_suspended = []
 
-# Return length of next string of non-space characters
-# or 0 if next character *is* a space.
+# Characters that are printed despite having no width (what bytes.isspace()
+# accepts).
 
-def len_next_word(uni):
-    if ' ' in uni:
-        return theme_len(uni.split(' ', 1)[0])
-    return theme_len(uni)
+SPACES = " \t\n\r\x0b\x0c"
+
+# Return length of next string of non-space characters starting at uni[start]
+# or 0 if that character *is* a space. widths and prefix are uni's char_widths
+# and prefix_widths, so a word without codes is just a subtraction.
+
+def len_next_word(uni, widths, prefix, start):
+    end = uni.find(' ', start)
+    if end < 0:
+        end = len(uni)
+
+    word = uni[start:end]
+    if '%' in word or '\\' in word:
+        return theme_len_widths(word, widths[start:end])
+    return prefix[end] - prefix[start]
+
+# Draw a run of text. It goes through the locale encoding so characters it
+# can't encode are drawn as the '?' their width was counted as.
+
+def draw_run(pad, s, cols):
+    if not s:
+        return
+
+    try:
+        pad.waddstr(encoder(s).decode(locale_enc, "replace"), cols)
+    except Exception as e:
+        log.debug("Can't print run: %s" % (repr(encoder(s)),))
+        log.debug("Exception: %s" % e)
 
 class FakePad():
     def __init__(self, width):
@@ -67,6 +93,12 @@ class FakePad():
             self.y += 1
             self.x -= self.width
 
+    def waddstr(self, s, cols):
+        self.x += cols
+        while self.x >= self.width:
+            self.y += 1
+            self.x -= self.width
+
     def getyx(self):
         return (self.y, self.x)
 
@@ -90,12 +122,116 @@ class WrapPad():
     def waddch(self, ch):
         waddch(self.pad, ch)
 
+    def waddstr(self, s, cols):
+        waddnwstr(self.pad, s)
+
     def getyx(self):
         return self.pad.getyx()
 
     def move(self, x, y):
         return self.pad.move(x, y)
 
+# A DisplayList stands in for a pad while theme_print lays out text, tracking
+# the cursor like FakePad, and records what was drawn as a list of runs of
+# text, attribute changes and cursor moves. That gives the line count without a
+# real pad, and blit() then draws the same thing onto a pad without laying it
+# out again.
+#
+# DL_TEXT runs are encoded characters given to waddch, DL_STR runs are whole
+# strings given to waddstr, which is what theme_print uses.
+
+DL_TEXT = 0
+DL_ATTRON = 1
+DL_ATTROFF = 2
+DL_CLRTOEOL = 3
+DL_MOVE = 4
+DL_STR = 5
+
+class DisplayList():
+    def __init__(self, width):
+        self.x = 0
+        self.y = 0
+        self.width = width
+        self.ops = []
+
+        # Current text run, flushed on any other op. Characters are kept as
+        # given (encoded), so a run is a tuple of them, not a string.
+        self.run = []
+
+    def flush_run(self):
+        if self.run:
+            self.ops.append((DL_TEXT, tuple(self.run)))
+            self.run = []
+
+    def attron(self, attr):
+        self.flush_run()
+        self.ops.append((DL_ATTRON, attr))
+
+    def attroff(self, attr):
+        self.flush_run()
+        self.ops.append((DL_ATTROFF, attr))
+
+    def clrtoeol(self):
+        self.flush_run()
+        self.ops.append((DL_CLRTOEOL,))
+
+    def waddch(self, ch):
+        self.run.append(ch)
+
+        cwidth = wcwidth(ch)
+        if cwidth < 0:
+            return
+
+        self.x += cwidth
+        if self.x >= self.width:
+            self.y += 1
+            self.x -= self.width
+
+    def waddstr(self, s, cols):
+        self.flush_run()
+        self.ops.append((DL_STR, s))
+
+        self.x += cols
+        while self.x >= self.width:
+            self.y += 1
+            self.x -= self.width
+
+    def getyx(self):
+        return (self.y, self.x)
+
+    def move(self, y, x):
+        self.flush_run()
+        self.ops.append((DL_MOVE, y, x))
+        self.y = y
+        self.x = x
+
+    # Draw onto a real pad. Like drawing directly, errors (i.e. writing off the
+    # end of the pad) are ignored.
+
+    def blit(self, pad):
+        self.flush_run()
+
+        for op in self.ops:
+            try:
+                if op[0] == DL_STR:
+                    waddnwstr(pad, op[1])
+                elif op[0] == DL_TEXT:
+                    for ch in op[1]:
+                        try:
+                            waddch(pad, ch)
+                        except:
+                            pass
+                elif op[0] == DL_ATTRON:
+                    pad.attron(op[1])
+                elif op[0] == DL_ATTROFF:
+                    pad.attroff(op[1])
+                elif op[0] == DL_CLRTOEOL:
+                    pad.clrtoeol()
+                else:
+                    pad.move(op[1], op[2])
+            except Exception as e:
+                log.debug("blit error: %s (%s)" % (e, op))
+
 def attr_debug(fn):
     def debug_wrapper(*args):
         log.debug("args: %s" % (args,))
@@ -123,25 +259,45 @@ def theme_print_one(pad, uni, width):
     long_code = False
     lc = ""
 
+    widths = char_widths(uni)
+    prefix = None
+
+    # Plain text that fits goes out as a single run.
+
+    if '%' not in uni and '\\' not in uni and '\n' not in uni and -1 not in widths:
+        total = sum(widths)
+        if total <= width:
+            draw_run(pad, uni, total)
+            return None
+
+    # Otherwise, printable characters are collected into a run that's drawn
+    # before any attribute change, and before returning.
+
+    run = ""
+    cols = 0
+
     for i, c in enumerate(uni):
-        ec = encoder(c)
-        cwidth = wcwidth(ec)
-        if cwidth < 0 and not ec.isspace():
+        cwidth = widths[i]
+        if cwidth < 0 and c not in SPACES:
             continue
 
         if escaped:
             # No room
             if cwidth > width:
+                draw_run(pad, run, cols)
                 return "\\" + uni[i:]
 
-            try:
-                pad.waddch(ec)
-            except:
-                log.debug("Can't print escaped ec: %s in: %s" % (ec, uni))
+            run += c
+            if cwidth > 0:
+                cols += cwidth
 
             width -= cwidth
             escaped = False
         elif code:
+            draw_run(pad, run, cols)
+            run = ""
+            cols = 0
+
             # Turn on color 1 - 8
             if c in "12345678":
                 if len(color_stack):
@@ -199,6 +355,10 @@ def theme_print_one(pad, uni, width):
             code = False
         elif long_code:
             if c == "]":
+                draw_run(pad, run, cols)
+                run = ""
+                cols = 0
+
                 try:
                     long_color = int(lc)
                 except:
@@ -221,33 +381,55 @@ def theme_print_one(pad, uni, width):
         elif c == "%":
             code = True
         elif c == "\n":
+            draw_run(pad, run, cols)
             return uni[i + 1:]
         else:
             if c == " ":
                 # Word too long
-                wwidth = len_next_word(uni[i + 1:])
+                if prefix is None:
+                    prefix = prefix_widths(uni)
+                wwidth = len_next_word(uni, widths, prefix, i + 1)
 
                 # >= to account for current character
                 if wwidth <= max_width and wwidth >= width:
+                    draw_run(pad, run, cols)
                     return uni[i + 1:]
 
             # Character too long (should be handled above).
             if cwidth > width:
+                draw_run(pad, run, cols)
                 return uni[i:]
 
-            try:
-                pad.waddch(ec)
-            except Exception as e:
-                log.debug("Can't print ec: %s in: %s" % (ec, repr(encoder(uni))))
-                log.debug("Exception: %s" % e)
+            run += c
+            if cwidth > 0:
+                cols += cwidth
 
             width -= cwidth
 
+    draw_run(pad, run, cols)
     return None
 
+# The native theme_print and theme_len (widecurse.c) do the same thing as the
+# Python versions below, in C. They draw characters as they are, rather than
+# through the locale encoding, which only agrees with the Python versions in a
+# UTF-8 locale, so they're only used there.
+
+use_native = "UTF-8" in locale_enc
+
 def theme_print(pad, uni, mwidth, pre = "", post = "", cursorbash=True, clear=True):
-    prel = theme_len(pre)
-    postl = theme_len(post)
+    if use_native:
+        # Let the native version draw straight onto the window.
+        if type(pad) == WrapPad:
+            pad = pad.pad
+
+        return native_theme_print(pad, uni, mwidth, pre, post, cursorbash,
+                clear, color_stack, attr_count)
+
+    return py_theme_print(pad, uni, mwidth, pre, post, cursorbash, clear)
+
+def py_theme_print(pad, uni, mwidth, pre = "", post = "", cursorbash=True, clear=True):
+    prel = py_theme_len(pre)
+    postl = py_theme_len(post)
     y = pad.getyx()[0]
 
     theme_print_one(pad, pre, prel)
@@ -283,15 +465,22 @@ def theme_print(pad, uni, mwidth, pre = "", post = "", cursorbash=True, clear=Tr
 # escapes and wide characters into account.
 
 def theme_len(uni):
+    if use_native:
+        return native_theme_len(uni)
+    return py_theme_len(uni)
+
+def py_theme_len(uni):
+    if '%' not in uni and '\\' not in uni:
+        return str_width(uni)
+    return theme_len_widths(uni, char_widths(uni))
+
+def theme_len_widths(uni, widths):
     escaped = False
     code = False
     length = 0
 
-    for c in uni:
-        ec = encoder(c)
-
-        cwidth = wcwidth(ec)
-        if cwidth < 0 and not ec.isspace():
+    for c, cwidth in zip(uni, widths):
+        if cwidth < 0 and c not in SPACES:
             continue
 
         if escaped:
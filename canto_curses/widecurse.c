@@ -83,6 +83,743 @@ static PyObject *py_wsize(PyObject * self, PyObject * args)
 	return Py_BuildValue("i", sizeof(WINDOW));
 }
 
+/* Native theme_print. This mirrors theme_print / theme_print_one / theme_len
+ * in theme.py, see there for the format codes, but instead of one encoder(),
+ * wcwidth() and waddch() round trip per character, it works on the string's
+ * code points and draws whole runs of same-attribute text at once.
+ *
+ * The target is either a curses window, which is drawn to directly, or any
+ * object with the pad interface (attron, attroff, waddstr, clrtoeol, getyx,
+ * move), like a DisplayList. The attribute state (color stack and attribute
+ * counts) is the list and dict owned by theme.py, and is updated in place.
+ */
+
+static int is_space(Py_UCS4 c)
+{
+	return (c == ' ' || c == '\t' || c == '\n' || c == '\r' || c == '\v'
+		|| c == '\f');
+}
+
+/* Character widths, as wcwidth(encoder(c)) would give them. The BMP table is
+ * built at import, other planes are allocated on first use and filled in a
+ * character at a time. Characters the locale can't encode count as 1, for the
+ * '?' they're replaced with.
+ *
+ * Entries are filled in with the GIL held, so they need no other locking.
+ */
+
+#define WIDTH_UNKNOWN -2
+#define WIDTH_PLANES 17
+
+static signed char *plane_widths[WIDTH_PLANES];
+
+static int compute_width(Py_UCS4 c)
+{
+	char buf[MB_LEN_MAX];
+	mbstate_t state;
+
+	memset(&state, 0, sizeof(state));
+	if (wcrtomb(buf, (wchar_t) c, &state) == (size_t) -1)
+		return 1;
+
+	return wcwidth((wchar_t) c);
+}
+
+static signed char *new_plane(Py_UCS4 plane)
+{
+	signed char *widths = PyMem_Malloc(0x10000);
+	Py_UCS4 i;
+
+	if (!widths)
+		return NULL;
+
+	if (plane == 0)
+		for (i = 0; i < 0x10000; i++)
+			widths[i] = compute_width(i);
+	else
+		memset(widths, WIDTH_UNKNOWN, 0x10000);
+
+	plane_widths[plane] = widths;
+	return widths;
+}
+
+static int char_width(Py_UCS4 c)
+{
+	Py_UCS4 plane = c >> 16;
+	signed char *widths;
+
+	if (plane >= WIDTH_PLANES)
+		return -1;
+
+	widths = plane_widths[plane];
+	if (!widths && !(widths = new_plane(plane)))
+		return compute_width(c);
+
+	if (widths[c & 0xFFFF] == WIDTH_UNKNOWN)
+		widths[c & 0xFFFF] = compute_width(c);
+
+	return widths[c & 0xFFFF];
+}
+
+/* char_widths(s) gives the width of each character, -1 for unprintable ones.
+ * str_width(s) gives the total width of s, and prefix_widths(s) the width of
+ * s[:i] for 0 <= i <= len(s), both counting unprintable characters as 0.
+ */
+
+static PyObject *py_char_widths(PyObject * self, PyObject * args)
+{
+	PyObject *uni, *r, *w;
+	Py_ssize_t len, i;
+	const void *data;
+	int kind;
+
+	if (!PyArg_ParseTuple(args, "U", &uni))
+		return NULL;
+
+	kind = PyUnicode_KIND(uni);
+	data = PyUnicode_DATA(uni);
+	len = PyUnicode_GET_LENGTH(uni);
+
+	r = PyList_New(len);
+	if (!r)
+		return NULL;
+
+	for (i = 0; i < len; i++) {
+		w = PyLong_FromLong(char_width(PyUnicode_READ(kind, data, i)));
+		if (!w) {
+			Py_DECREF(r);
+			return NULL;
+		}
+		PyList_SET_ITEM(r, i, w);
+	}
+	return r;
+}
+
+static PyObject *py_str_width(PyObject * self, PyObject * args)
+{
+	PyObject *uni;
+	Py_ssize_t len, i, width = 0;
+	const void *data;
+	int kind, cwidth;
+
+	if (!PyArg_ParseTuple(args, "U", &uni))
+		return NULL;
+
+	kind = PyUnicode_KIND(uni);
+	data = PyUnicode_DATA(uni);
+	len = PyUnicode_GET_LENGTH(uni);
+
+	for (i = 0; i < len; i++) {
+		cwidth = char_width(PyUnicode_READ(kind, data, i));
+		if (cwidth > 0)
+			width += cwidth;
+	}
+	return PyLong_FromSsize_t(width);
+}
+
+static PyObject *py_prefix_widths(PyObject * self, PyObject * args)
+{
+	PyObject *uni, *r, *w;
+	Py_ssize_t len, i, width = 0;
+	const void *data;
+	int kind, cwidth;
+
+	if (!PyArg_ParseTuple(args, "U", &uni))
+		return NULL;
+
+	kind = PyUnicode_KIND(uni);
+	data = PyUnicode_DATA(uni);
+	len = PyUnicode_GET_LENGTH(uni);
+
+	r = PyList_New(len + 1);
+	if (!r)
+		return NULL;
+
+	for (i = 0; i <= len; i++) {
+		w = PyLong_FromSsize_t(width);
+		if (!w) {
+			Py_DECREF(r);
+			return NULL;
+		}
+		PyList_SET_ITEM(r, i, w);
+
+		if (i < len) {
+			cwidth = char_width(PyUnicode_READ(kind, data, i));
+			if (cwidth > 0)
+				width += cwidth;
+		}
+	}
+	return r;
+}
+
+/* Width of uni[start:end], counted like theme_len */
+
+static int theme_len_range(int kind, const void *data, Py_ssize_t start,
+			   Py_ssize_t end)
+{
+	int escaped = 0, code = 0, length = 0;
+	Py_ssize_t i;
+
+	for (i = start; i < end; i++) {
+		Py_UCS4 c = PyUnicode_READ(kind, data, i);
+		int cwidth = char_width(c);
+
+		if (cwidth < 0 && !is_space(c))
+			continue;
+
+		if (escaped) {
+			length += cwidth;
+			escaped = 0;
+		} else if (code)
+			code = 0;
+		else if (c == '\\')
+			escaped = 1;
+		else if (c == '%')
+			code = 1;
+		else if (cwidth >= 0)
+			length += cwidth;
+	}
+	return length;
+}
+
+static PyObject *py_theme_len(PyObject * self, PyObject * args)
+{
+	PyObject *uni;
+
+	if (!PyArg_ParseTuple(args, "U", &uni))
+		return NULL;
+
+	return Py_BuildValue("i", theme_len_range(PyUnicode_KIND(uni),
+				PyUnicode_DATA(uni), 0, PyUnicode_GET_LENGTH(uni)));
+}
+
+typedef struct {
+	PyObject *pad;
+	WINDOW *win;		/* NULL if pad isn't a curses window */
+	PyObject *color_stack;
+	PyObject *attr_count;
+
+	wchar_t *run;
+	Py_ssize_t runlen;
+	int runcols;
+} theme_state;
+
+static const char attr_codes[] = "BDRSU";
+
+static long attr_value(char code)
+{
+	switch (code) {
+	case 'B':
+		return A_BOLD;
+	case 'D':
+		return A_DIM;
+	case 'R':
+		return A_REVERSE;
+	case 'S':
+		return A_STANDOUT;
+	}
+	return A_UNDERLINE;
+}
+
+static long attr_count_get(theme_state * st, char code)
+{
+	char key[2] = { code, 0 };
+	PyObject *count = PyDict_GetItemString(st->attr_count, key);
+
+	if (!count)
+		return 0;
+	return PyLong_AsLong(count);
+}
+
+static int attr_count_set(theme_state * st, char code, long count)
+{
+	char key[2] = { code, 0 };
+	PyObject *val = PyLong_FromLong(count);
+	int ret;
+
+	if (!val)
+		return -1;
+
+	ret = PyDict_SetItemString(st->attr_count, key, val);
+	Py_DECREF(val);
+	return ret;
+}
+
+/* Draw a run onto a window, leaving the cursor after it like waddch() */
+
+static void draw_run(WINDOW * win, wchar_t * run, Py_ssize_t len, int cols)
+{
+	int x, y;
+
+	getyx(win, y, x);
+	waddnwstr(win, run, len);
+	if (x + cols < getmaxx(win))
+		wmove(win, y, x + cols);
+}
+
+static int theme_flush(theme_state * st)
+{
+	PyObject *s, *r;
+
+	if (!st->runlen)
+		return 0;
+
+	if (st->win)
+		draw_run(st->win, st->run, st->runlen, st->runcols);
+	else {
+		s = PyUnicode_FromWideChar(st->run, st->runlen);
+		if (!s)
+			return -1;
+
+		/* Like the per-character waddch, a failed draw is ignored. */
+
+		r = PyObject_CallMethod(st->pad, "waddstr", "Oi", s, st->runcols);
+		Py_DECREF(s);
+		if (r)
+			Py_DECREF(r);
+		else
+			PyErr_Clear();
+	}
+
+	st->runlen = 0;
+	st->runcols = 0;
+	return 0;
+}
+
+static int theme_attr(theme_state * st, int on, long attr)
+{
+	PyObject *r;
+
+	if (theme_flush(st) < 0)
+		return -1;
+
+	if (st->win) {
+		if (on)
+			wattron(st->win, attr);
+		else
+			wattroff(st->win, attr);
+		return 0;
+	}
+
+	r = PyObject_CallMethod(st->pad, on ? "attron" : "attroff", "l", attr);
+	if (!r)
+		return -1;
+	Py_DECREF(r);
+	return 0;
+}
+
+static int theme_color(theme_state * st, int on, PyObject * pair)
+{
+	long n = PyLong_AsLong(pair);
+
+	if (n == -1 && PyErr_Occurred())
+		return -1;
+	return theme_attr(st, on, COLOR_PAIR(n));
+}
+
+static PyObject *theme_rest(PyObject * uni, Py_ssize_t i, int escaped)
+{
+	PyObject *tail, *r;
+
+	tail = PyUnicode_Substring(uni, i, PyUnicode_GET_LENGTH(uni));
+	if (!tail || !escaped)
+		return tail;
+
+	r = PyUnicode_FromFormat("\\%U", tail);
+	Py_DECREF(tail);
+	return r;
+}
+
+/* Returns 0 and sets *rest to the unprinted part of uni (NULL if it was all
+ * printed), or -1 with an exception set.
+ */
+
+static int theme_print_one(theme_state * st, PyObject * uni, int width,
+			   PyObject ** rest)
+{
+	int kind = PyUnicode_KIND(uni);
+	const void *data = PyUnicode_DATA(uni);
+	Py_ssize_t len = PyUnicode_GET_LENGTH(uni);
+	Py_ssize_t i, j, lclen = 0, stop = -1;
+	int max_width = width, escaped = 0, code = 0, long_code = 0, k;
+	int stop_escaped = 0;
+	PyObject *suspended = NULL, *stack = st->color_stack;
+	Py_UCS4 *lc = NULL;
+	int ret = -1;
+
+	*rest = NULL;
+
+	st->run = PyMem_New(wchar_t, len + 1);
+	st->runlen = 0;
+	st->runcols = 0;
+	if (!st->run) {
+		PyErr_NoMemory();
+		return -1;
+	}
+
+	for (i = 0; i < len; i++) {
+		Py_UCS4 c = PyUnicode_READ(kind, data, i);
+		int cwidth = char_width(c);
+
+		if (cwidth < 0 && !is_space(c))
+			continue;
+
+		if (escaped) {
+			/* No room */
+			if (cwidth > width) {
+				stop = i;
+				stop_escaped = 1;
+				break;
+			}
+
+			st->run[st->runlen++] = c;
+			if (cwidth > 0)
+				st->runcols += cwidth;
+
+			width -= cwidth;
+			escaped = 0;
+		} else if (code) {
+			Py_ssize_t depth = PyList_GET_SIZE(stack);
+
+			/* Turn on color 1 - 8 */
+			if (c >= '1' && c <= '8') {
+				PyObject *pair;
+
+				if (depth && theme_color(st, 0,
+						PyList_GET_ITEM(stack, depth - 1)) < 0)
+					goto done;
+
+				pair = PyLong_FromLong(c - '0');
+				if (!pair || PyList_Append(stack, pair) < 0) {
+					Py_XDECREF(pair);
+					goto done;
+				}
+				Py_DECREF(pair);
+
+				if (theme_attr(st, 1, COLOR_PAIR(c - '0')) < 0)
+					goto done;
+			}
+			/* Return to previous color */
+			else if (c == '0') {
+				if (depth && theme_color(st, 0,
+						PyList_GET_ITEM(stack, depth - 1)) < 0)
+					goto done;
+
+				if (depth >= 2) {
+					if (theme_color(st, 1,
+						PyList_GET_ITEM(stack, depth - 2)) < 0)
+						goto done;
+					if (PyList_SetSlice(stack, depth - 1, depth, NULL) < 0)
+						goto done;
+				} else {
+					if (theme_attr(st, 1, COLOR_PAIR(0)) < 0)
+						goto done;
+					if (PyList_SetSlice(stack, 0, depth, NULL) < 0)
+						goto done;
+				}
+			}
+			/* Turn attributes on / off */
+			else if (c && c < 128 && strchr("BbDdRrSsUu", (char) c)) {
+				char a = (char) Py_UNICODE_TOUPPER(c);
+				long count = attr_count_get(st, a);
+
+				if (count == -1 && PyErr_Occurred())
+					goto done;
+
+				count += (c == (Py_UCS4) a) ? 1 : -1;
+				if (attr_count_set(st, a, count) < 0)
+					goto done;
+
+				if (theme_attr(st, count ? 1 : 0, attr_value(a)) < 0)
+					goto done;
+			}
+			/* Suspend attributes */
+			else if (c == 'C') {
+				for (k = 0; attr_codes[k]; k++)
+					if (theme_attr(st, 0, attr_value(attr_codes[k])) < 0)
+						goto done;
+				for (j = depth - 1; j >= 0; j--)
+					if (theme_color(st, 0, PyList_GET_ITEM(stack, j)) < 0)
+						goto done;
+				if (theme_attr(st, 1, COLOR_PAIR(0)) < 0)
+					goto done;
+
+				Py_XDECREF(suspended);
+				suspended = PyList_GetSlice(stack, 0, depth);
+				if (!suspended || PyList_SetSlice(stack, 0, depth, NULL) < 0)
+					goto done;
+			}
+			/* Restore attributes */
+			else if (c == 'c') {
+				for (k = 0; attr_codes[k]; k++) {
+					long count = attr_count_get(st, attr_codes[k]);
+
+					if (count == -1 && PyErr_Occurred())
+						goto done;
+					if (count && theme_attr(st, 1,
+							attr_value(attr_codes[k])) < 0)
+						goto done;
+				}
+
+				if (PyList_SetSlice(stack, 0, depth, suspended) < 0)
+					goto done;
+				Py_CLEAR(suspended);
+
+				depth = PyList_GET_SIZE(stack);
+				if (depth) {
+					if (theme_color(st, 1,
+						PyList_GET_ITEM(stack, depth - 1)) < 0)
+						goto done;
+				} else if (theme_attr(st, 1, COLOR_PAIR(0)) < 0)
+					goto done;
+			} else if (c == '[') {
+				long_code = 1;
+				lclen = 0;
+				if (!lc && !(lc = PyMem_New(Py_UCS4, len + 1))) {
+					PyErr_NoMemory();
+					goto done;
+				}
+			}
+			code = 0;
+		} else if (long_code) {
+			if (c == ']') {
+				PyObject *lcs, *color;
+				long long_color;
+				int overflow;
+
+				/* Unknown or out of range codes are ignored, theme.py
+				 * logs them, here they're just dropped. */
+
+				lcs = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND,
+						lc, lclen);
+				if (!lcs)
+					goto done;
+				color = PyLong_FromUnicodeObject(lcs, 10);
+				Py_DECREF(lcs);
+
+				if (!color)
+					PyErr_Clear();
+				else {
+					long_color = PyLong_AsLongAndOverflow(color,
+							&overflow);
+					if (!overflow && long_color >= 1
+					    && long_color <= 256) {
+						if (theme_attr(st, 1,
+							COLOR_PAIR(long_color)) < 0)
+							PyErr_Clear();
+						else if (PyList_Append(stack, color) < 0) {
+							Py_DECREF(color);
+							goto done;
+						}
+					}
+					Py_DECREF(color);
+				}
+				long_code = 0;
+				lclen = 0;
+			} else
+				lc[lclen++] = c;
+		} else if (c == '\\')
+			escaped = 1;
+		else if (c == '%')
+			code = 1;
+		else if (c == '\n') {
+			stop = i + 1;
+			break;
+		} else {
+			if (c == ' ') {
+				/* Word too long */
+				Py_ssize_t end = PyUnicode_FindChar(uni, ' ', i + 1,
+						len, 1);
+				int wwidth = theme_len_range(kind, data, i + 1,
+						end < 0 ? len : end);
+
+				/* >= to account for current character */
+				if (wwidth <= max_width && wwidth >= width) {
+					stop = i + 1;
+					break;
+				}
+			}
+
+			/* Character too long (should be handled above). */
+			if (cwidth > width) {
+				stop = i;
+				break;
+			}
+
+			st->run[st->runlen++] = c;
+			if (cwidth > 0)
+				st->runcols += cwidth;
+
+			width -= cwidth;
+		}
+	}
+
+	if (theme_flush(st) < 0)
+		goto done;
+
+	if (stop >= 0 && !(*rest = theme_rest(uni, stop, stop_escaped)))
+		goto done;
+
+	ret = 0;
+
+ done:
+	Py_XDECREF(suspended);
+	PyMem_Free(lc);
+	PyMem_Free(st->run);
+	st->run = NULL;
+	return ret;
+}
+
+static int theme_getyx(theme_state * st, int *y)
+{
+	PyObject *r;
+	int x;
+
+	if (st->win) {
+		getyx(st->win, *y, x);
+		return 0;
+	}
+
+	r = PyObject_CallMethod(st->pad, "getyx", NULL);
+	if (!r)
+		return -1;
+
+	if (!PyArg_ParseTuple(r, "ii", y, &x)) {
+		Py_DECREF(r);
+		return -1;
+	}
+	Py_DECREF(r);
+	return 0;
+}
+
+/* Move errors are ignored, as in theme.py */
+
+static void theme_move(theme_state * st, int y, int x)
+{
+	PyObject *r;
+
+	if (st->win) {
+		wmove(st->win, y, x);
+		return;
+	}
+
+	r = PyObject_CallMethod(st->pad, "move", "ii", y, x);
+	if (r)
+		Py_DECREF(r);
+	else
+		PyErr_Clear();
+}
+
+static int theme_clrtoeol(theme_state * st)
+{
+	PyObject *r;
+
+	if (st->win) {
+		wclrtoeol(st->win);
+		return 0;
+	}
+
+	r = PyObject_CallMethod(st->pad, "clrtoeol", NULL);
+	if (!r)
+		return -1;
+	Py_DECREF(r);
+	return 0;
+}
+
+static PyObject *py_theme_print(PyObject * self, PyObject * args)
+{
+	PyObject *uni, *pre, *post, *r = NULL, *ignored;
+	int mwidth, cursorbash, clear, prel, postl, width, y;
+	theme_state st;
+
+	if (!PyArg_ParseTuple(args, "OUiUUppO!O!", &st.pad, &uni, &mwidth,
+			      &pre, &post, &cursorbash, &clear, &PyList_Type,
+			      &st.color_stack, &PyDict_Type, &st.attr_count))
+		return NULL;
+
+	st.win = NULL;
+	if (PyCurses_API && PyCursesWindow_Check(st.pad))
+		st.win = ((PyCursesWindowObject *) st.pad)->win;
+
+	prel = theme_len_range(PyUnicode_KIND(pre), PyUnicode_DATA(pre), 0,
+			       PyUnicode_GET_LENGTH(pre));
+	postl = theme_len_range(PyUnicode_KIND(post), PyUnicode_DATA(post), 0,
+				PyUnicode_GET_LENGTH(post));
+
+	if (theme_getyx(&st, &y) < 0)
+		return NULL;
+
+	if (theme_print_one(&st, pre, prel, &ignored) < 0)
+		return NULL;
+	Py_XDECREF(ignored);
+
+	width = (mwidth - prel) - postl;
+	if (width <= 0) {
+		PyErr_SetString(PyExc_Exception, "theme_print: NO ROOM!");
+		return NULL;
+	}
+
+	if (theme_print_one(&st, uni, width, &r) < 0)
+		return NULL;
+
+	if (clear && theme_clrtoeol(&st) < 0)
+		goto error;
+
+	if (PyUnicode_GET_LENGTH(post)) {
+		theme_move(&st, y, mwidth - postl);
+		if (theme_print_one(&st, post, postl, &ignored) < 0)
+			goto error;
+		Py_XDECREF(ignored);
+	}
+
+	if (cursorbash)
+		theme_move(&st, y + 1, 0);
+
+	if (!r)
+		Py_RETURN_NONE;
+
+	if (PyUnicode_Compare(r, uni) == 0) {
+		PyErr_SetString(PyExc_Exception, "theme_print: didn't advance!");
+		goto error;
+	}
+
+	return r;
+
+ error:
+	Py_XDECREF(r);
+	return NULL;
+}
+
+static PyObject *py_waddnwstr(PyObject * self, PyObject * args)
+{
+	PyObject *window, *uni;
+	wchar_t *run;
+	Py_ssize_t len, i;
+	int cols = 0, cwidth;
+
+	if (!PyArg_ParseTuple(args, "OU", &window, &uni))
+		return NULL;
+
+	if (!PyCurses_API || !PyCursesWindow_Check(window)) {
+		PyErr_SetString(PyExc_TypeError, "waddnwstr: not a curses window");
+		return NULL;
+	}
+
+	run = PyUnicode_AsWideCharString(uni, &len);
+	if (!run)
+		return NULL;
+
+	for (i = 0; i < len; i++) {
+		cwidth = char_width(run[i]);
+		if (cwidth > 0)
+			cols += cwidth;
+	}
+
+	draw_run(((PyCursesWindowObject *) window)->win, run, len, cols);
+	PyMem_Free(run);
+	Py_RETURN_NONE;
+}
+
 /* set_hook and on_hook are taken directly from Python's readline.c and are
  * included to make turning the following code into a patch to it trivial
  */
@@ -213,8 +950,20 @@ static PyObject *py_get_rlpoint(PyObject * self, PyObject * args)
 
 static PyMethodDef WCMethods[] = {
 	{"waddch", (PyCFunction) py_waddch, METH_VARARGS, "waddch() wrapper."},
+	{"waddnwstr", (PyCFunction) py_waddnwstr, METH_VARARGS,
+	 "waddnwstr() wrapper, draws a whole run."},
 	{"wcwidth", (PyCFunction) py_wcwidth, METH_VARARGS,
 	 "wcwidth() wrapper."},
+	{"theme_print", (PyCFunction) py_theme_print, METH_VARARGS,
+	 "Native theme_print."},
+	{"theme_len", (PyCFunction) py_theme_len, METH_VARARGS,
+	 "Native theme_len."},
+	{"char_widths", (PyCFunction) py_char_widths, METH_VARARGS,
+	 "Width of each character in a string."},
+	{"str_width", (PyCFunction) py_str_width, METH_VARARGS,
+	 "Printed width of a string."},
+	{"prefix_widths", (PyCFunction) py_prefix_widths, METH_VARARGS,
+	 "Printed width of each prefix of a string."},
 	{"wsize", (PyCFunction) py_wsize, METH_VARARGS,
 	 "Returns sizeof(WINDOW)"},
 	{"set_redisplay_callback", (PyCFunction) py_set_redisplay_callback,
@@ -241,5 +990,14 @@ static struct PyModuleDef moduledef = {
 
 PyMODINIT_FUNC PyInit_widecurse(void)
 {
+	/* Without _curses, theme_print only draws through the pad interface. */
+
+	import_curses();
+	if (!PyCurses_API)
+		PyErr_Clear();
+
+	if (!plane_widths[0] && !new_plane(0))
+		return PyErr_NoMemory();
+
 	return PyModule_Create(&moduledef);
 }
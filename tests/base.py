@@ -142,7 +142,10 @@ class Test(object):
             raise Exception("Expected flags %d - got %d" % (value, self.flags))
 
     def compare_config(self, config, var, evalue):
-        ok, got = access_dict(config, var)
+        # Config snapshots are read-only dict subclasses, which access_dict
+        # won't walk, so compare against a plain copy.
+
+        ok, got = access_dict(json.loads(json.dumps(config)), var)
         if not ok:
             raise Exception("Couldn't get %s?" % var)
         if got != evalue:
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Not a test, run by hand to compare interpreting the default story and tag
+# formats (eval_theme_string) with running them compiled.
+
+from base import *
+
+from canto_curses.parser import parse_conditionals, eval_theme_string,\
+        compile_theme_string, prep_for_display
+from canto_curses.config import DEFAULT_FSTRING, DEFAULT_TAG_FSTRING
+from canto_curses.rendercontext import PASSTHRU_ESCAPES
+
+import time
+
+RUNS = 20000
+
+logging.getLogger().setLevel(logging.WARNING)
+
+values = { "sel" : False, "m" : False, "rd" : True, "c" : False,
+        "t" : prep_for_display("Some story title"), "l" : "http://example.com",
+        "ut" : [], "n" : 12, "pending" : 0, "pre" : "", "post" : "",
+        "prep" : prep_for_display }
+
+for esc in PASSTHRU_ESCAPES:
+    values[esc] = "%" + esc
+
+for attr in [ "selected", "read", "marked" ]:
+    for var in [ attr, "un" + attr, attr + "_end", "un" + attr + "_end" ]:
+        values[var] = "%" + var[0]
+
+def measure(f):
+    start = time.time()
+    for i in range(RUNS):
+        f(values)
+    return (time.time() - start) / RUNS * 1000000
+
+for name, fmt in [ ("story", DEFAULT_FSTRING), ("tag", DEFAULT_TAG_FSTRING) ]:
+    parsed = parse_conditionals(fmt)
+
+    start = time.time()
+    compiled = compile_theme_string(parsed)
+    compile_time = (time.time() - start) * 1000
+
+    if compiled(values) != eval_theme_string(parsed, values):
+        raise Exception("Compiled %s format doesn't match!" % name)
+
+    interpreted = measure(lambda v : eval_theme_string(parsed, v))
+    run = measure(compiled)
+
+    print("%s format:" % name)
+    print("  interpreted: %8.2f us" % interpreted)
+    print("  compiled:    %8.2f us (%.1fx, compiled once in %.2fms)" %\
+            (run, interpreted / run, compile_time))
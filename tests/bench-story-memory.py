@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Not a test, run by hand to see how much memory each Story costs, both cold
+# (as every story in a Tag starts out) and materialized (on screen).
+
+from base import *
+
+from canto_curses.main import CANTO_PROTOCOL_COMPATIBLE
+from canto_curses.config import config
+from canto_curses.tagcore import tag_updater, TagCore
+from canto_curses.tag import Tag
+
+import tracemalloc
+import sys
+import gc
+
+STORIES = 10000
+
+config_script = {
+    'VERSION' : { '*' : [('VERSION', CANTO_PROTOCOL_COMPATIBLE)] },
+    'CONFIGS' : { '*' : [('CONFIGS', { "CantoCurses" : config.template_config })] },
+}
+
+logging.getLogger().setLevel(logging.WARNING)
+
+config.init(TestBackend("config", config_script), CANTO_PROTOCOL_COMPATIBLE)
+tag_updater.init(TestBackend("tagcore", {}))
+
+vars = { "selected" : None }
+
+callbacks = {
+    "get_var" : lambda x : vars.get(x, None),
+    "set_var" : lambda x, y : vars.__setitem__(x, y),
+    "get_opt" : config.get_opt,
+    "set_opt" : config.set_opt,
+    "get_tag_opt" : config.get_tag_opt,
+    "set_tag_opt" : config.set_tag_opt,
+    "release_gui" : lambda : None,
+}
+
+tagcore = TagCore("maintag:bench")
+tag = Tag(tagcore, callbacks)
+
+ids = [ "story-%d" % i for i in range(STORIES) ]
+tagcore.update_items(ids, ids, [])
+
+def measure(f):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    f()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / STORIES
+
+# Sync, and link the stories up the way TagList.refresh() does.
+
+def sync():
+    tag.sync()
+
+    prev = None
+    for story in tag:
+        story.curpos = 0
+        story.prev_obj = story.prev_story = story.prev_sel = prev
+        story.next_obj = story.next_story = story.next_sel = None
+        if prev:
+            prev.next_obj = prev.next_story = prev.next_sel = story
+        prev = story
+
+def materialize():
+    for story in tag:
+        story.materialize()
+
+cold = measure(sync)
+live = measure(materialize)
+
+print("%d stories" % STORIES)
+print("cold:         %6d bytes/story" % cold)
+print("materialized: %6d bytes/story (+%d)" % (cold + live, live))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Not a test, run by hand to compare the per-line cost of laying out story
+# lines with the Python theme_print and the native one.
+
+import sys
+
+sys.modules['curses'] = __import__("fake_curses")
+
+from base import *
+
+import canto_curses.theme as theme
+
+import time
+
+RUNS = 20000
+WIDTH = 80
+
+logging.getLogger().setLevel(logging.WARNING)
+
+LEFT = "%C%B│%b %c"
+RIGHT = "%C %B│%b%c"
+
+LINES = [
+    ("ascii", "%1%BSome story title, long enough to be a realistic headline%b%0"),
+    ("wrapped", "A much longer story title that doesn't fit in eighty columns and so "
+        "has to be wrapped onto a second line by theme_print"),
+    ("wide", "%1日本語のタイトル、これはかなり長いタイトルです%0"),
+]
+
+def measure(f, uni):
+    start = time.time()
+    for i in range(RUNS):
+        pad = theme.DisplayList(WIDTH)
+        s = uni
+        while s:
+            s = f(pad, s, WIDTH, LEFT, RIGHT)
+    return (time.time() - start) / RUNS * 1000000
+
+for name, uni in LINES:
+    python = measure(theme.py_theme_print, uni)
+    native = measure(theme.theme_print, uni)
+
+    print("%s line:" % name)
+    print("  python: %8.2f us" % python)
+    print("  native: %8.2f us (%.1fx)" % (native, python / native))
@@ -78,6 +78,10 @@ class CursesPad():
             self.y += 1
             self.x -= self.width
 
+    def waddstr(self, s, cols):
+        for c in s:
+            self.waddch(c)
+
     def overwrite(self, dest_pad, sminrow, smincol, dminrow, dmincol, dmaxrow, dmaxcol):
         rows = (dmaxrow - dminrow) + 1
         cols = (dmaxcol - dmincol) + 1
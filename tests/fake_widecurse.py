@@ -3,6 +3,10 @@
 def waddch(pad, ch):
     pad.waddch(ch)
 
+def waddnwstr(pad, s):
+    for c in s:
+        pad.waddch(c)
+
 import sys
 
 self = sys.modules[__name__]
@@ -170,11 +170,91 @@ class TestConfigFunction(Test):
         self.compare_config(config.vars, "curtags", [ "maintag:Slashdot", "maintag:Test3", "maintag:Test2"])
         self.reset_flags()
 
-        c = config.get_conf()
+        c = config.copy_conf()
         c["tags"] = "alt:.*"
         config.set_conf(c)
 
         self.compare_flags(OPT_CHANGE | EVAL_TAGS)
+
+        # 8. Snapshots are shared, read-only, and only replaced on change
+
+        self.reset_flags()
+
+        snap = config.get_conf()
+        gen = config.generation
+
+        if config.get_conf() is not snap:
+            raise Exception("Expected get_conf() to return the same snapshot!")
+
+        try:
+            snap["tags"] = "broken"
+        except TypeError:
+            pass
+        else:
+            raise Exception("Expected snapshot to be read-only!")
+
+        config.set_conf(config.copy_conf())
+
+        self.compare_flags(0)
+        if config.get_conf() is not snap or config.generation != gen:
+            raise Exception("Unchanged set_conf() shouldn't publish a snapshot!")
+
+        config.set_opt("browser.path", "snapshot")
+
+        self.compare_flags(OPT_CHANGE)
+        if config.generation == gen:
+            raise Exception("Expected set_opt() to publish a new snapshot!")
+        if snap["browser"]["path"] == "snapshot":
+            raise Exception("Old snapshot changed underneath reader!")
+
+        # 9. Cached options are only invalidated by changes that touch them
+
+        config.get_opt("browser.path")
+        config.get_opt("story.format")
+        config.get_opt("taglist.key.x")
+        config.get_tag_opt("maintag:Slashdot", "collapsed")
+
+        config.set_opt("browser.path", "cached")
+
+        if config.get_opt("browser.path") != "cached":
+            raise Exception("Stale browser.path: %s" % config.get_opt("browser.path"))
+        if "story.format" not in config.opt_cache:
+            raise Exception("Unrelated change invalidated story.format!")
+
+        config.set_opt("taglist.key.x", "next-item")
+
+        if config.get_opt("taglist.key.x") != "next-item":
+            raise Exception("Stale taglist.key.x: %s" % config.get_opt("taglist.key.x"))
+
+        config.set_tag_opt("maintag:Slashdot", "collapsed", True)
+
+        if config.get_tag_opt("maintag:Slashdot", "collapsed") != True:
+            raise Exception("Stale tag option collapsed!")
+
+        # 10. Deleting a key from a dict option (i.e. unbinding a key) should
+        # be detected against the snapshot, and sent to the daemon
+
+        c = config.copy_conf()
+        del c["taglist"]["key"]["space"]
+
+        changes, deletions = config.validate_config(c, config.config, config.validators)
+
+        if deletions != { "taglist" : { "key" : { "space" : "DELETE" } } }:
+            raise Exception("Bad deletions: %s" % deletions)
+
+        backend.output = []
+
+        c = config.copy_conf()
+        del c["taglist"]["key"]["space"]
+        config.set_conf(c)
+
+        dels = [ args for (cmd, args) in backend.output if cmd == "DELCONFIGS" ]
+
+        if dels != [ { "CantoCurses" : { "taglist" : { "key" : { "space" : "DELETE" } } } } ]:
+            raise Exception("Expected unbind to be written: %s" % dels)
+        if "space" in config.get_opt("taglist.key"):
+            raise Exception("Expected space to be unbound!")
+
         return True
 
 TestConfigFunction("config function")
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_curses.main import CANTO_PROTOCOL_COMPATIBLE
+from canto_curses.config import config
+
+from canto_next.hooks import on_hook
+
+# Like TestBackend, but every connect() is a separate connection with its own
+# responses, and like the daemon, SETCONFIGS is echoed as CONFIGS to every
+# other connection that sent WATCHCONFIGS.
+
+class LaneBackend(TestBackend):
+    def __init__(self, prefix, script):
+        TestBackend.__init__(self, prefix, script)
+        self.queues = []
+        self.watchers = []
+        self.echoes = 0
+
+    def connect(self):
+        self.queues.append([])
+        return len(self.queues) - 1
+
+    def do_write(self, conn, cmd, args):
+        self.output.append((conn, cmd, args))
+
+        self.lock.acquire()
+        if cmd == "WATCHCONFIGS":
+            self.watchers.append(conn)
+        elif cmd == "SETCONFIGS":
+            for watcher in self.watchers:
+                if watcher != conn:
+                    self.queues[watcher].append(("CONFIGS", args))
+                    self.echoes += 1
+        elif cmd in self.script:
+            self.queues[conn].extend(self.script[cmd]['*'])
+        self.lock.release()
+
+    def do_read(self, conn):
+        self.lock.acquire()
+        while self.queues[conn] == []:
+            self.lock.release()
+            time.sleep(0.1)
+            self.lock.acquire()
+
+        r = self.queues[conn].pop(0)
+        self.lock.release()
+        return r
+
+class TestConfigLanes(Test):
+    def on_opt_change(self, opts):
+        self.opt_changes += 1
+
+    def check(self):
+        script = {
+            'VERSION' : { '*' : [('VERSION', CANTO_PROTOCOL_COMPATIBLE)] },
+            'CONFIGS' : { '*' : [('CONFIGS', { "CantoCurses" : config.template_config })] },
+        }
+
+        backend = LaneBackend("config", script)
+
+        config.init(backend, CANTO_PROTOCOL_COMPATIBLE)
+
+        if config.conn == config.pconn:
+            raise Exception("Expected two connections!")
+
+        self.opt_changes = 0
+        on_hook("curses_opt_change", self.on_opt_change)
+
+        # 1. Changes should go out on the connection watching configs, so they
+        # aren't echoed back to us
+
+        config.set_opt("browser.path", "first")
+        config.set_opt("browser.path", "second")
+
+        watching = [ conn for (conn, cmd, args) in backend.output if cmd == "WATCHCONFIGS" ]
+        writing = [ conn for (conn, cmd, args) in backend.output if cmd == "SETCONFIGS" ]
+
+        if writing != watching * 2:
+            raise Exception("Expected changes on %s, got %s" % (watching, writing))
+        if backend.echoes:
+            raise Exception("Our own changes were echoed %d times" % backend.echoes)
+        if self.opt_changes != 2:
+            raise Exception("Expected two opt changes, got %d" % self.opt_changes)
+        if config.get_opt("browser.path") != "second":
+            raise Exception("Expected second change to stick!")
+
+        return True
+
+TestConfigLanes("config lanes")
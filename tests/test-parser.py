@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_curses.parser import parse_conditionals, eval_theme_string, try_parse,\
+        get_parse_stats, parse_cache, PARSE_CACHE_SIZE, compile_theme_string,\
+        prep_for_display
+from canto_curses.config import DEFAULT_FSTRING, DEFAULT_TAG_FSTRING
+from canto_curses.rendercontext import PASSTHRU_ESCAPES
+
+import itertools
+
+# Formats for the compiler to match the interpreter on, including the
+# defaults, and the corner cases of _eval_simple.
+
+FORMATS = [
+    DEFAULT_FSTRING,
+    DEFAULT_TAG_FSTRING,
+    "",
+    "plain text",
+    "%t %l %x %",
+    "%{t + l}%{len(ut)}%{",
+    "\\%t \\\\%t %\\tl %{'\\}'}",
+    "%{}%{{t}}%{t}}",
+    "%{{t}}%{t}}",
+    "%?{sel}(a:b)%?{sel}(only true)%?{not sel}(x:y:z)",
+    "%?{m}(%?{rd}(%?{sel}(1:2):3):%?{rd}(4:%?{sel}(5:6)))",
+    "%?{bad syntax}(a:b) after",
+    "%?{missing}(a:b)",
+    "%?{sel}(%{missing}:%t)",
+    "%?{sel}((nested (parens)):\\(escaped\\:\\))",
+    "%?{rd}(%{prep('%t & <b>')}:%8%B%t%b%0)",
+    "%?{sel}(a",
+]
+
+def outcome(f, *args):
+    try:
+        return ("ok", f(*args))
+    except Exception as e:
+        return ("exception", type(e))
+
+def all_values():
+    for sel, m, rd, c in itertools.product([ True, False ], repeat=4):
+        values = { "sel" : sel, "m" : m, "rd" : rd, "c" : c,
+                "t" : prep_for_display("A <b>title</b> & 100%"), "l" : "link",
+                "ut" : [ "user:a" ], "n" : 3, "pending" : 0 if rd else 2,
+                "pre" : "[pre]", "post" : "", "prep" : prep_for_display }
+        for esc in PASSTHRU_ESCAPES:
+            values[esc] = "%" + esc
+        for attr in [ "selected", "read", "marked" ]:
+            for var in [ attr, "un" + attr, attr + "_end", "un" + attr + "_end" ]:
+                values[var] = "%%%s" % var[0]
+        yield values
+
+class TestParser(Test):
+    def check(self):
+        fmt = "%?{a}(A%?{b}(B:b):%?{c}(C:c)) %t"
+
+        # 1. Cached trees should evaluate the same as fresh ones, and be shared
+
+        stats = get_parse_stats()
+
+        parsed = try_parse(fmt, DEFAULT_FSTRING)
+        again = try_parse(fmt, DEFAULT_FSTRING)
+
+        if parsed is not again:
+            raise Exception("Expected cached tree to be shared!")
+
+        after = get_parse_stats()
+        if after["hits"] != stats["hits"] + 1 or after["misses"] != stats["misses"] + 1:
+            raise Exception("Bad stats: %s -> %s" % (stats, after))
+
+        for a in [ True, False ]:
+            for b in [ True, False ]:
+                values = { "a" : a, "b" : b, "c" : not b, "t" : "title" }
+                fresh = eval_theme_string(parse_conditionals(fmt), values)
+                cached = eval_theme_string(parsed, values)
+                if fresh != cached:
+                    raise Exception("Cached %s != fresh %s" % (cached, fresh))
+
+        # 2. Shared trees should be read-only all the way down
+
+        def frozen(tree):
+            if not isinstance(tree, tuple):
+                return False
+            for term in tree:
+                if type(term) == dict:
+                    for topkey in term:
+                        for subkey in term[topkey]:
+                            if not frozen(term[topkey][subkey]):
+                                return False
+            return True
+
+        if not frozen(parsed):
+            raise Exception("Expected frozen tree: %s" % (parsed,))
+
+        # 3. The compiler should give the same output as the interpreter, or
+        # fail the same way, for every format and set of values
+
+        for fmt in FORMATS:
+            tree = parse_conditionals(fmt)
+            compiled = compile_theme_string(tree)
+            for values in all_values():
+                expected = outcome(eval_theme_string, tree, values)
+                got = outcome(compiled, values)
+                if got != expected:
+                    raise Exception("Compiled %r gave %s, expected %s for %s" %\
+                            (fmt, got, expected, values))
+
+        # And cached trees evaluate compiled
+
+        parsed = try_parse(DEFAULT_FSTRING, DEFAULT_FSTRING)
+        for values in all_values():
+            if parsed.evaluate(values) != eval_theme_string(parsed, values):
+                raise Exception("Cached evaluation doesn't match!")
+        if not parsed.compiled:
+            raise Exception("Expected cached tree to be compiled!")
+
+        # 4. The cache should be bounded
+
+        for i in range(PARSE_CACHE_SIZE + 10):
+            try_parse("%%?{x}(%d:)" % i, DEFAULT_FSTRING)
+
+        if len(parse_cache) != PARSE_CACHE_SIZE or not get_parse_stats()["evictions"]:
+            raise Exception("Expected cache to be bounded: %s" % get_parse_stats())
+
+        return True
+
+TestParser("parser")
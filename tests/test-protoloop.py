@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_curses.protoloop import protocol_loop, start_timer, takes_timeout, LoopTimer
+from canto_curses.subthread import SubThread
+
+from threading import Event, current_thread
+import socket
+
+# Like the daemon's sockets, every response written in one go is buffered by
+# the first read, but only makes the fd readable once.
+
+class SocketBackend(object):
+    def __init__(self, responses):
+        self.responses = responses
+        self.peers = {}
+        self.buffered = {}
+        self.timeouts = []
+
+    def connect(self):
+        ours, peer = socket.socketpair()
+        ours.setblocking(False)
+        self.peers[ours] = peer
+        self.buffered[ours] = []
+        return ours
+
+    def do_write(self, conn, cmd, args):
+        self.buffered[conn].extend(self.responses.get(cmd, []))
+        self.peers[conn].send(b"x")
+
+    def do_read(self, conn, timeout=None):
+        self.timeouts.append(timeout)
+        try:
+            conn.recv(4096)
+        except BlockingIOError:
+            pass
+
+        if self.buffered[conn]:
+            return self.buffered[conn].pop(0)
+        return None
+
+class NoTimeoutBackend(SocketBackend):
+    def do_read(self, conn):
+        return SocketBackend.do_read(self, conn)
+
+class PingThread(SubThread):
+    def init(self, backend, expected):
+        SubThread.init(self, backend)
+        self.pongs = []
+        self.threads = set()
+        self.expected = expected
+        self.done = Event()
+
+    def prot_pong(self, args):
+        self.pongs.append(args)
+        self.threads.add(current_thread())
+        if len(self.pongs) == self.expected:
+            self.done.set()
+
+class TestProtoLoop(Test):
+    def check(self):
+        protocol_loop.start()
+
+        # 1. Only backends whose do_read takes a timeout can be drained
+
+        if not takes_timeout(SocketBackend({})):
+            raise Exception("Expected timeout to be detected!")
+        if takes_timeout(NoTimeoutBackend({})):
+            raise Exception("Expected no timeout to be detected!")
+
+        # 2. Both lanes should be read on the loop, and everything the backend
+        # buffered should be dispatched, not just the first response
+
+        responses = { "PING" : [ ("PONG", 1), ("PONG", 2), ("PONG", 3) ] }
+
+        sub = PingThread()
+        sub.init(SocketBackend(responses), 6)
+        sub.start_pthread()
+
+        if sub.prot_thread or sub.pprot_thread:
+            raise Exception("Expected the loop to read, not threads!")
+
+        sub.write("PING", [])
+        sub.write("PING", [], True)
+
+        if not sub.done.wait(5):
+            raise Exception("Expected every response, got %s" % sub.pongs)
+        if sorted(sub.pongs) != [ 1, 1, 2, 2, 3, 3 ]:
+            raise Exception("Bad responses: %s" % sub.pongs)
+        if sub.threads != set([ protocol_loop.thread ]):
+            raise Exception("Expected dispatch on the loop thread: %s" % sub.threads)
+        if None in sub.backend.timeouts:
+            raise Exception("Expected only non-blocking reads: %s" % sub.backend.timeouts)
+
+        # 3. A readable fd without a whole response shouldn't block the loop
+
+        sub = PingThread()
+        sub.init(SocketBackend(responses), 3)
+        sub.start_pthread()
+
+        sub.write("PARTIAL", [])
+        sub.write("PING", [])
+
+        if not sub.done.wait(5):
+            raise Exception("Expected responses after a partial read, got %s" % sub.pongs)
+
+        # 4. A backend without a timeout still gets its first response
+
+        sub = PingThread()
+        sub.init(NoTimeoutBackend(responses), 1)
+        sub.start_pthread()
+
+        sub.write("PING", [])
+
+        if not sub.done.wait(5):
+            raise Exception("Expected a response without draining!")
+
+        # 5. Timers should run on the loop, and not at all if cancelled
+
+        fired = Event()
+        threads = []
+
+        def fire():
+            threads.append(current_thread())
+            fired.set()
+
+        t = start_timer(0.01, fire)
+        if type(t) != LoopTimer:
+            raise Exception("Expected a loop timer, got %s" % t)
+        if not fired.wait(5) or threads != [ protocol_loop.thread ]:
+            raise Exception("Expected timer to fire on the loop: %s" % threads)
+
+        cancelled = Event()
+        t = start_timer(0.05, cancelled.set)
+        t.cancel()
+
+        if cancelled.wait(0.2):
+            raise Exception("Cancelled timer fired!")
+
+        protocol_loop.stop()
+        protocol_loop.wait()
+
+        if protocol_loop.running:
+            raise Exception("Expected loop to stop!")
+
+        return True
+
+TestProtoLoop("protoloop")
@@ -16,6 +16,7 @@ from canto_curses.tagcore import tag_updater, alltagcores
 from canto_curses.gui import CantoCursesGui # to Screen to curses
 from canto_curses.locks import sync_lock
 from canto_curses.taglist import TagList
+from canto_curses.story import livestories
 from canto_curses.tag import alltags
 
 from canto_next.hooks import on_hook, call_hook
@@ -306,6 +307,22 @@ class TestScreen(Test):
         if curses.pairs[8] != [ 0, 0 ]:
             raise Exception("Pair not immediately honored! %s" % curses.pairs[8])
 
+    # With no margin, only stories that made it on screen should be
+    # materialized.
+
+    def test_live(self):
+        taglist = self.get_taglist()
+
+        live = [ s for tag in alltags for s in tag if s.live ]
+
+        if not live:
+            raise Exception("No stories materialized!")
+        if len(live) > taglist.height:
+            raise Exception("Too many stories materialized: %d" % len(live))
+        for story in live:
+            if story not in livestories:
+                raise Exception("Untracked live story %s" % story)
+
     def check(self):
         taglist = self.get_taglist()
 
@@ -323,6 +340,9 @@ class TestScreen(Test):
 
         self.check_taglist()
 
+        config.set_opt("taglist.story_margin", 0)
+        self.test_command("rel-set-cursor 1", self.test_live)
+
         return True
 
 TestScreen("screen")
@@ -5,7 +5,7 @@ from base import *
 
 from canto_curses.main import CANTO_PROTOCOL_COMPATIBLE
 from canto_curses.config import config
-from canto_curses.tagcore import tag_updater, alltagcores
+from canto_curses.tagcore import tag_updater, alltagcores, TagCore, MAX_RECORD_DEPTH, UPDATE_WINDOW
 
 from canto_next.hooks import on_hook, call_hook
 
@@ -17,13 +17,21 @@ ATTRIBUTES = 16
 UPDATE_COMPLETE = 32
 
 class FakeTag(object):
-    def __init__(self, tag):
+    def __init__(self, tag, collapsed=False):
         self.tag = tag
+        self.collapsed = collapsed
 
 class FakeStory(object):
     def __init__(self, id):
         self.id = id
 
+class FakeSubscriber(object):
+    def __init__(self):
+        self.got = None
+
+    def on_attributes(self, attributes):
+        self.got = attributes
+
 class TestTagCoreFunction(Test):
 
     def reset_flags(self):
@@ -279,6 +287,396 @@ class TestTagCoreFunction(Test):
 
         tag_backend.inject("PONG", {})
 
+        # 15. Chunked ITEMS should reconcile to the daemon's order, with a
+        # single delta of what was added and removed
+
+        tc = [ t for t in alltagcores if t.tag == "maintag:Test1" ][0]
+
+        tag_backend.inject("ITEMS", { "maintag:Test1" : [ "id3", "id4" ] })
+        tag_backend.inject("ITEMSDONE", {})
+
+        self.reset_flags()
+
+        tag_backend.inject("ITEMS", { "maintag:Test1" : [ "id5", "id4" ] })
+        tag_backend.inject("ITEMS", { "maintag:Test1" : [ "id5", "id3" ] })
+        tag_backend.inject("ITEMSDONE", {})
+
+        self.compare_flags(ITEMS_ADDED)
+        self.compare_var("oia_tcids", [ "id5" ])
+
+        if tc != [ "id5", "id4", "id3" ] or tc.index("id3") != 2:
+            raise Exception("Bad order: %s" % tc)
+
+        self.reset_flags()
+
+        tag_backend.inject("ITEMS", { "maintag:Test1" : [ "id3" ] })
+        tag_backend.inject("ITEMS", { "maintag:Test1" : [ "id4" ] })
+        tag_backend.inject("ITEMSDONE", {})
+
+        self.compare_flags(ITEMS_REMOVED)
+        self.compare_var("oir_tcids", [ "id5" ])
+
+        if tc != [ "id3", "id4" ] or "id5" in tc:
+            raise Exception("Bad order: %s" % tc)
+
+        # 16. Changes should be available by generation until a reset
+
+        gen = tc.generation
+
+        tag_backend.inject("ITEMS", { "maintag:Test1" : [ "id4", "id3" ] })
+        tag_backend.inject("ITEMSDONE", {})
+
+        if tc.changes_since(gen) != ([], True):
+            raise Exception("Expected move: %s" % (tc.changes_since(gen),))
+
+        tag_backend.inject("ITEMS", { "maintag:Test1" : [ "id4", "id6" ] })
+        tag_backend.inject("ITEMSDONE", {})
+
+        if tc.changes_since(gen) != ([ "id6", "id3" ], True):
+            raise Exception("Bad changes: %s" % (tc.changes_since(gen),))
+        if tc.changes_since(tc.generation) != ([], False):
+            raise Exception("Expected no changes!")
+
+        tc.reset()
+
+        if tc.changes_since(gen) != None:
+            raise Exception("Expected no delta across reset!")
+
+        # 17. Attribute subscribers should only get their own ids, and the
+        # hook should only get what changed
+
+        sub = FakeSubscriber()
+        tag_updater.subscribe(sub, [ "id3" ])
+
+        self.reset_flags()
+
+        tag_backend.inject("ATTRIBUTES", { "id3" : { "test" : "new" }, "id5" : { "test" : "new" }})
+
+        self.compare_flags(ATTRIBUTES)
+        self.compare_var("attributes", { "id3" : { "test" : "new" }, "id5" : { "test" : "new" }})
+
+        if sub.got != { "id3" : { "test" : "new" } }:
+            raise Exception("Bad subscriber update: %s" % sub.got)
+
+        tag_updater.unsubscribe(sub, [ "id3" ])
+        sub.got = None
+
+        tag_backend.inject("ATTRIBUTES", { "id3" : { "test" : "newer" }})
+
+        if sub.got != None:
+            raise Exception("Unsubscribed, but still got %s" % sub.got)
+
+        # 18. Needed attributes should be requested in batches
+
+        tag_backend.output = []
+
+        tag_updater.need_attributes("id3", [ "test" ])
+        tag_updater.need_attributes("id4", [ "test" ])
+        tag_updater.need_attributes("id3", [ "other" ])
+        tag_updater.flush_attributes()
+
+        writes = [ args for (cmd, args) in tag_backend.output if cmd == "ATTRIBUTES" ]
+
+        if len(writes) != 1 or sorted(writes[0].keys()) != [ "id3", "id4" ]:
+            raise Exception("Expected one batched request, got %s" % writes)
+        if "other" not in writes[0]["id3"] or "test" not in writes[0]["id3"]:
+            raise Exception("Expected merged needs for id3, got %s" % writes[0]["id3"])
+
+        # 19. Prefetching should only request items missing needed attributes
+
+        full = dict([ (attr, "") for attr in tag_updater.needed_attrs ])
+        tag_backend.inject("ATTRIBUTES", { "id3" : full })
+
+        tag_backend.output = []
+
+        if tag_updater.prefetch_attributes([ "id3", "id4" ]) != 1:
+            raise Exception("Expected only id4 to be prefetched!")
+
+        tag_updater.flush_attributes()
+
+        writes = [ args for (cmd, args) in tag_backend.output if cmd == "ATTRIBUTES" ]
+
+        if writes != [ { "id4" : tag_updater.needed_attrs } ]:
+            raise Exception("Bad prefetch: %s" % writes)
+
+        # 20. Going over budget should slim down the least recently rendered,
+        # unpinned entries, keeping what the format / search need, and coming
+        # back should count as a refetch
+
+        sub = FakeSubscriber()
+        tag_updater.subscribe(sub, [ "id6" ])
+
+        # Like adding to story.format_attrs and taglist.search_attributes
+
+        tag_updater.need_attributes("id6", [ "author" ])
+        tag_updater.need_attributes("id6", [ "summary" ])
+        tag_updater.flush_attributes()
+
+        tag_backend.inject("ATTRIBUTES", {
+            "id6" : { "title" : "id6", "author" : "a", "summary" : "s",
+                "description" : "x" * 1000 },
+            "id7" : { "title" : "id7", "description" : "x" * 1000 },
+            "id8" : { "title" : "id8", "description" : "x" * 1000 }})
+
+        tag_updater.touch_attributes([ "id7" ])
+
+        config.set_opt("update.attribute_budget", tag_updater.attr_bytes - 1)
+
+        tag_backend.inject("ATTRIBUTES", { "id9" : { "title" : "id9" } })
+
+        stats = tag_updater.get_attribute_stats()
+
+        if "description" in tag_updater.attributes["id6"]:
+            raise Exception("Expected id6 to be evicted!")
+        if "description" not in tag_updater.attributes["id7"]:
+            raise Exception("Pinned id7 shouldn't be evicted!")
+        if sub.got != { "id6" : { "title" : "id6", "author" : "a", "summary" : "s" } }:
+            raise Exception("Subscriber didn't get slimmed id6: %s" % sub.got)
+        if stats["evictions"] < 1 or stats["bytes"] > config.get_opt("update.attribute_budget"):
+            raise Exception("Bad eviction stats: %s" % stats)
+
+        config.set_opt("update.attribute_budget", 0)
+
+        tag_backend.inject("ATTRIBUTES", { "id6" : { "description" : "x" } })
+
+        if tag_updater.get_attribute_stats()["refetches"] != 1:
+            raise Exception("Expected refetch to be counted!")
+
+        # 21. Updates should create new versions sharing unchanged attributes,
+        # and leave old versions alone
+
+        big = [ "x" ] * 100
+
+        tag_backend.inject("ATTRIBUTES", { "id10" : { "title" : "id10", "content" : big }})
+        old = tag_updater.get_attributes("id10")
+
+        for i in range(MAX_RECORD_DEPTH + 2):
+            tag_backend.inject("ATTRIBUTES", { "id10" : { "canto-state" : [ str(i) ] }})
+
+        new = tag_updater.get_attributes("id10")
+
+        if "canto-state" in old:
+            raise Exception("Old version changed: %s" % old)
+        if new != { "title" : "id10", "content" : big, "canto-state" : [ str(i) ] }:
+            raise Exception("Bad new version: %s" % new)
+        if new["content"] is not big:
+            raise Exception("Expected content to be shared!")
+        if new.version != old.version + MAX_RECORD_DEPTH + 2 or new.depth > MAX_RECORD_DEPTH:
+            raise Exception("Bad version / depth: %s / %s" % (new.version, new.depth))
+
+        # 22. State changes should be merged per id and written behind, with
+        # pending changes winning over in-flight responses
+
+        tag_backend.output = []
+
+        tag_updater.set_attributes({ "id10" : { "canto-state" : [ "read" ] }})
+        tag_updater.set_attributes({ "id10" : { "canto-state" : [] },
+            "id11" : { "canto-tags" : [ "user:x" ] }})
+
+        if [ cmd for (cmd, args) in tag_backend.output if cmd == "SETATTRIBUTES" ]:
+            raise Exception("Expected state changes to be held!")
+
+        tag_backend.inject("ATTRIBUTES", { "id10" : { "canto-state" : [ "read" ] }})
+
+        if tag_updater.get_attributes("id10")["canto-state"] != []:
+            raise Exception("Stale response reverted pending change!")
+
+        call_hook("curses_exit", [])
+
+        writes = [ args for (cmd, args) in tag_backend.output if cmd == "SETATTRIBUTES" ]
+
+        if writes != [ { "id10" : { "canto-state" : [] }, "id11" : { "canto-tags" : [ "user:x" ] } } ]:
+            raise Exception("Expected one merged write on exit, got %s" % writes)
+
+        # 23. The tagcore registry should be indexed by name, in order, and
+        # follow tags being deleted and re-added
+
+        tag_updater.on_new_tag("maintag:Registry")
+
+        tc = alltagcores.get("maintag:Registry")
+        if tc is None or alltagcores[-1] is not tc or tc not in alltagcores:
+            raise Exception("Expected new tagcore to be registered last!")
+
+        tag_updater.on_del_tag("maintag:Registry")
+
+        if "maintag:Registry" in alltagcores or tc in alltagcores:
+            raise Exception("Expected deleted tagcore to be unregistered!")
+
+        tag_updater.on_new_tag("maintag:Registry")
+
+        if alltagcores.tags().count("maintag:Registry") != 1 or alltagcores.get("maintag:Registry") is tc:
+            raise Exception("Expected one fresh tagcore after re-adding!")
+
+        # 24. Updates should keep a bounded window in flight, visible and
+        # uncollapsed tags first, and time each tag
+
+        ptags = [ "maintag:P%d" % i for i in range(UPDATE_WINDOW * 2) ]
+        for tag in ptags:
+            TagCore(tag)
+
+        strtags = config.vars["strtags"]
+        config.vars["strtags"] = ptags
+        config.vars["taglist_visible_tags"] = [ FakeTag(ptags[-1]),
+                FakeTag(ptags[-2], True) ]
+
+        self.reset_flags()
+        tag_backend.output = []
+
+        tag_updater.update()
+
+        sent = [ args[0] for (cmd, args) in tag_backend.output if cmd == "ITEMS" ]
+        if sent != [ ptags[-1] ] + ptags[:UPDATE_WINDOW - 1]:
+            raise Exception("Bad initial window: %s" % sent)
+
+        for i in range(len(ptags)):
+            tag = sent[i]
+            tag_backend.inject("ITEMS", { tag : [] })
+            tag_backend.inject("ITEMSDONE", {})
+            sent = [ args[0] for (cmd, args) in tag_backend.output if cmd == "ITEMS" ]
+            if len(sent) != min(len(ptags), UPDATE_WINDOW + i + 1):
+                raise Exception("Expected window to refill, sent %s" % sent)
+
+        self.compare_flags(UPDATE_COMPLETE)
+
+        if sorted([ t for (t, l) in tag_updater.get_update_stats() if t in ptags ]) != sorted(ptags):
+            raise Exception("Expected latency for every tag!")
+
+        config.vars["taglist_visible_tags"] = []
+
+        # Deleting a tag while its refresh is in flight shouldn't stall the
+        # update, whether or not its ITEMSDONE shows up
+
+        config_backend.inject("NEWTAGS", [ "maintag:A", "maintag:B" ])
+        config.vars["strtags"] = [ "maintag:A", "maintag:B" ]
+
+        self.reset_flags()
+        tag_updater.update()
+
+        config_backend.inject("DELTAGS", [ "maintag:A" ])
+
+        tag_backend.inject("ITEMS", { "maintag:A" : [ "id30" ] })
+        tag_backend.inject("ITEMSDONE", {})
+        tag_backend.inject("ITEMS", { "maintag:B" : [] })
+        tag_backend.inject("ITEMSDONE", {})
+
+        self.compare_flags(DEL_TC | UPDATE_COMPLETE)
+
+        if tag_updater.update_inflight or tag_updater.still_updating:
+            raise Exception("Update stuck on %s" % list(tag_updater.update_inflight))
+
+        if tag_updater.reset() != True:
+            raise Exception("Shouldn't have rejected reset()!")
+
+        tag_backend.inject("PONG", {})
+
+        config.vars["strtags"] = [ t for t in strtags if t != "maintag:A" ]
+
+        # 25. Interactive requests should go over the priority lane
+
+        before = tag_updater.get_lane_stats()
+
+        tag_updater.request_attributes("id10", [ "description" ])
+        tag_updater.set_attributes({ "id10" : { "canto-state" : [ "read" ] }})
+        tag_updater.flush_writes()
+
+        after = tag_updater.get_lane_stats()
+
+        if after["priority"]["writes"] - before["priority"]["writes"] != 2:
+            raise Exception("Expected two priority writes: %s" % after)
+        if after["bulk"]["writes"] != before["bulk"]["writes"]:
+            raise Exception("Expected no bulk writes: %s" % after)
+
+        # 26. Responses should be timed per command
+
+        stats = tag_updater.get_proto_stats()
+
+        for cmd in [ "ITEMS", "ITEMSDONE", "ATTRIBUTES" ]:
+            if cmd not in stats or not stats[cmd]["count"]:
+                raise Exception("Expected stats for %s: %s" % (cmd, stats))
+            if not stats[cmd]["p50"] <= stats[cmd]["p99"] <= stats[cmd]["max"]:
+                raise Exception("Bad percentiles for %s: %s" % (cmd, stats[cmd]))
+
+        if not tag_updater.proto_stats_lines("tagcore"):
+            raise Exception("Expected stats lines!")
+
+        # 27. While staging, attribute updates should be merged and only
+        # applied in batches, with requested ids first
+
+        releases = []
+        tag_updater.start_staging(lambda : releases.append(1))
+
+        tag_updater.request_attributes("id22", [ "description" ])
+
+        tag_backend.inject("ATTRIBUTES", { "id20" : { "title" : "id20" }})
+        tag_backend.inject("ATTRIBUTES", { "id21" : { "title" : "id21" }})
+        tag_backend.inject("ATTRIBUTES", { "id20" : { "link" : "link20" }})
+        tag_backend.inject("ATTRIBUTES", { "id22" : { "description" : "d" }})
+
+        if len(releases) != 1:
+            raise Exception("Expected one release, got %s" % len(releases))
+        if tag_updater.get_attributes("id20") or tag_updater.get_attributes("id22"):
+            raise Exception("Expected updates to be staged!")
+
+        if tag_updater.apply_staged(1) != 2 or not tag_updater.get_attributes("id22"):
+            raise Exception("Expected requested id to be applied first!")
+
+        tag_updater.stop_staging()
+
+        if tag_updater.get_attributes("id20") != { "title" : "id20", "link" : "link20" }:
+            raise Exception("Expected merged update: %s" % tag_updater.get_attributes("id20"))
+
+        # 28. Lazy mode should be switchable at runtime, and while it's on
+        # new items should have their attributes trickled in
+
+        tag_backend.output = []
+
+        config.set_opt("update.lazy.enabled", True)
+
+        autoattr = [ args for (cmd, args) in tag_backend.output if cmd == "AUTOATTR" ]
+        if autoattr != [ [] ]:
+            raise Exception("Expected AUTOATTR to be cleared: %s" % autoattr)
+
+        tag_backend.inject("ATTRIBUTES", { "id40" : {} })
+
+        if "id40" in tag_updater.attributes:
+            raise Exception("Shouldn't store empty attributes!")
+
+        TagCore("maintag:Trickle")
+        tag_backend.inject("ITEMS", { "maintag:Trickle" : [ "id40", "id41" ] })
+        tag_backend.inject("ITEMSDONE", {})
+
+        if not tag_updater.trickle_timer:
+            raise Exception("Expected new items to start a trickle!")
+        tag_updater.trickle_timer.cancel()
+
+        config.set_opt("update.lazy.trickle", 1000)
+        tag_updater.trickle_pos = (0, 0)
+        tag_backend.output = []
+
+        tag_updater.trickle_attributes()
+        tag_updater.trickle_timer.cancel()
+        tag_updater.flush_attributes()
+
+        writes = [ args for (cmd, args) in tag_backend.output if cmd == "ATTRIBUTES" ]
+
+        if len(writes) != 1 or "id40" not in writes[0] or "id41" not in writes[0]:
+            raise Exception("Expected new items to be trickled: %s" % writes)
+        if writes[0]["id40"] != tag_updater.needed_attrs:
+            raise Exception("Bad trickle request: %s" % writes[0]["id40"])
+
+        tag_backend.output = []
+
+        config.set_opt("update.lazy.enabled", False)
+
+        autoattr = [ args for (cmd, args) in tag_backend.output if cmd == "AUTOATTR" ]
+        if autoattr != [ tag_updater.needed_attrs ]:
+            raise Exception("Expected AUTOATTR to be restored: %s" % autoattr)
+
+        tag_updater.trickle_attributes()
+
+        if tag_updater.trickle_timer or [ c for (c, a) in tag_backend.output if c == "ATTRIBUTES" ]:
+            raise Exception("Expected trickle to stop without lazy mode!")
+
         return True
 
 TestTagCoreFunction("tagcore function")
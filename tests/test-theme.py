@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+
+sys.modules['curses'] = __import__("fake_curses")
+
+from base import *
+
+from canto_curses.widecurse import wcwidth, theme_print as native_theme_print,\
+        char_widths, str_width, prefix_widths
+import canto_curses.theme as theme
+
+import locale
+
+# Compare against wcwidth in a UTF-8 locale where there is one, like main sets
+# it up, rather than whatever the test happens to be run in.
+
+try:
+    locale.setlocale(locale.LC_ALL, "C.UTF-8")
+except locale.Error:
+    locale.setlocale(locale.LC_ALL, "")
+
+# A pad that just remembers what ends up in each cell, so the Python
+# theme_print and the native one can be compared by what they draw, rather
+# than how.
+
+class GridPad():
+    def __init__(self, width, height = 10):
+        self.width = width
+        self.height = height
+        self.cells = {}
+        self.attrs = 0
+        self.x = 0
+        self.y = 0
+
+    def attron(self, attr):
+        self.attrs |= attr
+
+    def attroff(self, attr):
+        self.attrs &= ~attr
+
+    def clrtoeol(self):
+        for x in range(self.x, self.width):
+            self.cells[(self.y, x)] = (" ", self.attrs)
+
+    def put(self, c):
+        cwidth = wcwidth(c.encode("UTF-8"))
+        if cwidth < 0:
+            return
+        self.cells[(self.y, self.x)] = (c, self.attrs)
+        self.x += cwidth
+        if self.x >= self.width:
+            self.y += 1
+            self.x -= self.width
+
+    def waddch(self, ch):
+        self.put(ch.decode("UTF-8"))
+
+    def waddstr(self, s, cols):
+        for c in s:
+            self.put(c)
+
+    def getyx(self):
+        return (self.y, self.x)
+
+    def move(self, y, x):
+        if y >= self.height or x >= self.width:
+            raise Exception("Bad move")
+        self.y = y
+        self.x = x
+
+    def state(self):
+        return (self.cells, self.attrs, self.y, self.x)
+
+LEFT = "%C%B│%b %c"
+RIGHT = "%C %B│%b%c"
+
+LINES = [
+    ("plain", "", ""),
+    ("%1%BSome story title%b%0 and the rest", LEFT, RIGHT),
+    ("a line that is long enough that it has to be wrapped somewhere", LEFT, RIGHT),
+    ("averyveryverylongwordthatcantbewrappedatall and then some", "", ""),
+    ("%R%2reverse %3nested%0%0%r %U%Dmany%d%u %S%s", "", ""),
+    ("escaped \\%B \\\\ \\% \\\\%B%b", "", RIGHT),
+    ("日本語のタイトル、とても長いタイトルです", LEFT, RIGHT),
+    ("wide 日本語 words 日本語 wrapping 日本語", "", ""),
+    ("combining éé and zero​width", "", ""),
+    ("first line\nsecond line", "", ""),
+    ("%[12]long color%0 %[300]out of range %[x]bad", "", ""),
+    ("%C%1suspended%c restored", "%2", ""),
+    ("ends in an escape \\", "", ""),
+    ("escaped ab%\x00cd NUL", "", ""),
+    ("tab\tand \x01control \U0001F600 emoji \U0001F600\U0001F600", "", ""),
+    ("", LEFT, RIGHT),
+]
+
+def outcome(f, *args):
+    try:
+        return ("ok", f(*args))
+    except Exception as e:
+        return ("exception", str(e))
+
+class TestTheme(Test):
+    def check(self):
+
+        # The native versions are only used in a UTF-8 locale, elsewhere
+        # there's nothing to compare against, but the Python versions should
+        # still run on everything.
+
+        for uni, pre, post in LINES:
+            for width in [ 4, 9, 20, 40, 80 ]:
+                for cursorbash, clear in [ (True, True), (False, False) ]:
+                    args = (uni, width, pre, post, cursorbash, clear)
+
+                    theme.color_stack = [ 5 ]
+                    theme.attr_count.update({ "B" : 1, "D" : 0, "R" : 0, "S" : 0, "U" : 0 })
+                    pad = GridPad(width)
+                    expected = outcome(theme.py_theme_print, pad, *args)
+                    expected = (expected, pad.state(), theme.color_stack, theme.attr_count.copy())
+
+                    if not theme.use_native:
+                        continue
+
+                    stack = [ 5 ]
+                    counts = { "B" : 1, "D" : 0, "R" : 0, "S" : 0, "U" : 0 }
+                    pad = GridPad(width)
+                    got = outcome(native_theme_print, pad, *(args + (stack, counts)))
+                    got = (got, pad.state(), stack, counts)
+
+                    if got != expected:
+                        raise Exception("%r: got %s, expected %s" % (args, got, expected))
+
+                if not theme.use_native:
+                    theme.py_theme_len(pre + uni)
+                elif theme.py_theme_len(pre + uni) != theme.theme_len(pre + uni):
+                    raise Exception("theme_len mismatch: %r" % (pre + uni,))
+
+        # The width table should agree with wcwidth on encoded characters
+
+        sample = "ascii 日本語 e\u0301 \t\x01\u200b \U0001F600\U00020000"
+        widths = char_widths(sample)
+        prefix = prefix_widths(sample)
+
+        for c, w in zip(sample, widths):
+            if not theme.use_native:
+                break
+            if w != wcwidth(c.encode("UTF-8")):
+                raise Exception("Width of %r: %s != %s" % (c, w, wcwidth(c.encode("UTF-8"))))
+
+        for i in range(len(sample) + 1):
+            if prefix[i] != sum([ w for w in widths[:i] if w > 0 ]):
+                raise Exception("Bad prefix width %d: %s" % (i, prefix))
+
+        if str_width(sample) != prefix[-1]:
+            raise Exception("Bad str_width: %s" % str_width(sample))
+
+        # A DisplayList should record native runs, and count lines the same
+
+        for uni, pre, post in LINES:
+            native = theme.DisplayList(20)
+            theme.theme_print(native, uni, 20, pre, post)
+
+            python = theme.DisplayList(20)
+            theme.py_theme_print(python, uni, 20, pre, post)
+
+            if native.getyx() != python.getyx():
+                raise Exception("DisplayList mismatch: %s vs %s" % (native.getyx(), python.getyx()))
+
+        return True
+
+TestTheme("theme")